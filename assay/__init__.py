@@ -36,4 +36,29 @@ class assert_raises(object):
             raise e
         return True
 
-__all__ = ['assert_raises']
+SCOPES = ('module', 'session')
+
+def fixture(scope):
+    """Decorate a fixture whose values are computed only once per `scope`.
+
+    Normally a fixture is called again for every test that names it.
+    A fixture in the 'module' scope is instead called once for all the
+    tests of a module, and one in the 'session' scope once for all the
+    tests run by a process.  Its values are cached until its scope ends.
+
+    A scoped fixture that is a generator should yield only once; the
+    code after its ``yield`` is run as teardown when its scope ends, or
+    sooner if the cache is evicted because memory is running short.
+
+    A scoped fixture can take other fixtures as parameters, so long as
+    their scopes are at least as wide as its own.
+
+    """
+    if scope not in SCOPES:
+        raise ValueError('fixture scope must be one of {0}'.format(SCOPES))
+    def decorate(function):
+        function.assay_scope = scope
+        return function
+    return decorate
+
+__all__ = ['assert_raises', 'fixture']
@@ -142,7 +142,7 @@ else:
 if _python_version <= (3,5):
 
     assert_pattern_text = assemble_pattern([
-        b'(', b'|'.join(operator_patterns), b')', 0,
+        b'(', b'|'.join(sorted(operator_patterns)), b')', 0,
         op.pop_jump_if_true, b'..',
         op.load_global, b'(..)',
         op.raise_varargs, 1, 0,
@@ -158,7 +158,7 @@ if _python_version <= (3,5):
 elif _python_version <= (3,8):
 
     assert_pattern_text = assemble_pattern([
-        b'(', b'|'.join(operator_patterns), b')',
+        b'(', b'|'.join(sorted(operator_patterns)), b')',
         b'(?:', op.extended_arg, b'.)?',
         op.pop_jump_if_true, b'.',
         op.load_global, b'(.)',
@@ -175,7 +175,7 @@ elif _python_version <= (3,8):
 elif _python_version <= (3,10):
 
     assert_pattern_text = assemble_pattern([
-        b'(', b'|'.join(operator_patterns), b')',
+        b'(', b'|'.join(sorted(operator_patterns)), b')',
         b'(?:', op.extended_arg, b'.)?',
         op.pop_jump_if_true, b'.',
         op.load_assertion_error, 0,
@@ -268,7 +268,7 @@ else:
         operator_patterns.add(pattern)
         replacements[i] = replacement
 
-    assert_pattern_text = b'(' + b'|'.join(operator_patterns) + b')'
+    assert_pattern_text = b'(' + b'|'.join(sorted(operator_patterns)) + b')'
 
     # Wrap comparison methods in objects that implement the __setitem__
     # and __delitem__ methods that will be invoked by the replacement
@@ -283,38 +283,246 @@ else:
 # an ASCII newline.
 assert_pattern = re.compile(assert_pattern_text, re.S)
 
-def rewrite_asserts_in(function):
+# Since Python 3.6 every instruction is two bytes long, so instead of
+# searching with the pattern above, which can backtrack and can match a
+# run of bytes that straddles two instructions, we decode the handful of
+# instructions that make up each stanza.  A stanza starts with one of
+# the comparisons in `bytecode_map`, whose operand some versions need
+# to have masked first; is followed by any inline cache entries; and
+# then by the instructions in `stanza_tails` for its opcode, the last of
+# which is always a RAISE_VARARGS.  Each combination of those has a
+# fixed length, and is precomputed as an entry in `stanza_templates`.
+
+if _python_version >= (3,6):
+
+    ANY = None  # stands in for an operand that can have any value
+
+    def inline_cache_units(opcode):
+        entries = getattr(dis, '_inline_cache_entries', None)
+        if entries is None:
+            return 0
+        if isinstance(entries, dict):
+            return entries.get(dis.opname[opcode], 0)
+        return entries[opcode]
+
+    instruction_sizes = [2 + 2 * inline_cache_units(i) for i in range(256)]
+    operand_masks = [0xff] * 256
+    if _python_version == (3,12):
+        operand_masks[op.compare_op] = 0b11110000
+
+    stanza_heads = dict(((bytecode[0], bytecode[1]), i)
+                        for bytecode, i in bytecode_map.items())
+
+    if _python_version <= (3,10):
+        if _python_version <= (3,8):
+            load_error = (op.load_global, ANY)
+        else:
+            load_error = (op.load_assertion_error, 0)
+        tail = ((op.pop_jump_if_true, ANY), load_error, (op.raise_varargs, 1))
+        stanza_tails = dict((head_opcode, tail)
+                            for head_opcode, operand in stanza_heads)
+        jump_may_be_extended = True
+    else:
+        stanza_tails = {
+            op.compare_op: ((jump_if_true, 2),
+                            (op.load_assertion_error, ANY),
+                            (op.raise_varargs, 1)),
+            op.contains_op: ((jump_if_true, 2),
+                             (op.load_assertion_error, 0),
+                             (op.raise_varargs, 1)),
+            op.is_op: ((jump_if_true, 2),
+                       (op.load_assertion_error, 0),
+                       (op.raise_varargs, 1)),
+            jump_if_none: ((op.load_assertion_error, 0),
+                           (op.raise_varargs, 1)),
+            jump_if_not_none: ((op.load_assertion_error, 0),
+                               (op.raise_varargs, 1)),
+        }
+        jump_may_be_extended = False
+
+    def build_template(head_opcode, extended):
+        """Return ``(length, head_opcode, checks)`` for a kind of stanza."""
+        checks = []
+        offset = instruction_sizes[head_opcode]
+        if extended:
+            checks.append((offset, op.extended_arg, ANY))
+            offset += 2
+        for opcode, operand in stanza_tails[head_opcode]:
+            checks.append((offset, opcode, operand))
+            offset += instruction_sizes[opcode]
+        return offset, head_opcode, tuple(checks)
+
+    stanza_templates = [
+        build_template(head_opcode, extended)
+        for head_opcode in sorted(stanza_tails)
+        for extended in ((False, True) if jump_may_be_extended else (False,))
+    ]
+    raise_instruction = assemble_replacement([op.raise_varargs, 1])
+
+def find_asserts(bytecode):
+    """Yield ``(start, end, comparison_index)`` for each assert stanza.
+
+    Assert stanzas are found by looking for the RAISE_VARARGS that ends
+    each of them, using a fast ``find()``, and then checking whether the
+    instructions that precede it match one of our templates.  The cost
+    is therefore linear in the length of the `bytecode`, without any of
+    the backtracking of a regular expression.  Requires Python 3.6+.
+
+    """
+    find = bytecode.find
+    heads = stanza_heads
+    masks = operand_masks
+    templates = stanza_templates
+    previous_end = 0
+    i = find(raise_instruction)
+    while i != -1:
+        if i % 2:
+            i = find(raise_instruction, i + 1)
+            continue
+        end = i + 2
+        for length, head_opcode, checks in templates:
+            start = end - length
+            if start < previous_end or bytecode[start] != head_opcode:
+                continue
+            operand = bytecode[start + 1] & masks[head_opcode]
+            index = heads.get((head_opcode, operand))
+            if index is None:
+                continue
+            for offset, opcode, operand in checks:
+                if bytecode[start + offset] != opcode or (
+                        operand is not ANY
+                        and bytecode[start + offset + 1] != operand):
+                    break
+            else:
+                yield start, end, index
+                previous_end = end
+                break
+        i = find(raise_instruction, end)
+
+def rewrite_bytecode(bytecode, offset):
+    """Rewrite the asserts in `bytecode`, returning ``(bytecode, count)``.
+
+    The `offset` is the index at which the `comparison_constants` will
+    be appended to the code object's constants.
+
+    """
+    if _python_version <= (3,5):
+        return rewrite_bytecode_with_pattern(bytecode, offset)
+    pieces = []
+    previous_end = 0
+    for start, end, comparison_index in find_asserts(bytecode):
+        pieces.append(bytecode[previous_end:start])
+        pieces.append(replacement_for(comparison_index, offset, end - start))
+        previous_end = end
+    if not pieces:
+        return bytecode, 0
+    pieces.append(bytecode[previous_end:])
+    return b''.join(pieces), len(pieces) // 2
+
+def rewrite_bytecode_with_pattern(bytecode, offset):
+    """Rewrite asserts by searching with `assert_pattern`; see above."""
 
     def replace(match):
         comparison_bytecode = match.group(1)
         comparison_key = comparison_bytecode[:2]  # comparison instruction
         comparison_key = clear_bits(comparison_key)
         comparison_index = bytecode_map[comparison_key]
-        if _python_version >= (3,11):
-            code = replacements[comparison_index]
-            code = code.replace(b'%%', chr(offset + comparison_index))
-        elif _python_version >= (3,6):
-            code = replacement.replace(b'%%', chr(offset + comparison_index))
-        else:
-            msb, lsb = divmod(offset + comparison_index, 256)
-            code = replacement.replace(b'%%', chr(lsb) + chr(msb))
-        short = len(match.group(0)) - len(code)
-        if short < 0:
-            raise ValueError('Internal error in Assay: bytecode overflow')
-        if short > 0:
-            code += chr(op.nop) * short
-        return code
-
-    c = get_code(function)
-    offset = len(c.co_consts)
-    newcode = assert_pattern.sub(replace, c.co_code)
-    code_object = code_object_replace(
-        c,
-        new_code=newcode,
-        new_consts=c.co_consts + comparison_constants,
-        new_stacksize=c.co_stacksize + 1,
+        return replacement_for(comparison_index, offset, len(match.group(0)))
+
+    return assert_pattern.subn(replace, bytecode)
+
+def replacement_for(comparison_index, offset, length):
+    """Return `length` bytes of code that call a comparison method."""
+    if _python_version >= (3,11):
+        code = replacements[comparison_index]
+        code = code.replace(b'%%', chr(offset + comparison_index))
+    elif _python_version >= (3,6):
+        code = replacement.replace(b'%%', chr(offset + comparison_index))
+    else:
+        msb, lsb = divmod(offset + comparison_index, 256)
+        code = replacement.replace(b'%%', chr(lsb) + chr(msb))
+    short = length - len(code)
+    if short < 0:
+        raise ValueError('Internal error in Assay: bytecode overflow')
+    if short > 0:
+        code += chr(op.nop) * short
+    return code
+
+def rewrite_asserts_in(function):
+    """Rewrite the asserts in a function to explain how they failed."""
+    set_code(function, rewrite_asserts_in_code(get_code(function)))
+
+def rewrite_asserts_in_code(c):
+    """Return a copy of a code object with its asserts rewritten.
+
+    The code objects of nested functions and classes, which live among
+    its constants, are rewritten too.  A code object without asserts is
+    returned unchanged.
+
+    """
+    consts = tuple(
+        rewrite_asserts_in_code(const) if isinstance(const, types.CodeType)
+        else const
+        for const in c.co_consts
+    )
+    offset = len(consts)
+    if _python_version >= (3,6) and offset + len(comparison_constants) > 256:
+        count = 0   # a one-byte operand could not reach our constants
+    else:
+        newcode, count = rewrite_bytecode(c.co_code, offset)
+    if count:
+        return code_object_replace(
+            c,
+            new_code=newcode,
+            new_consts=consts + comparison_constants,
+            new_stacksize=c.co_stacksize + 1,
+        )
+    if consts != c.co_consts:
+        return code_object_replace(
+            c,
+            new_code=c.co_code,
+            new_consts=consts,
+            new_stacksize=c.co_stacksize,
+        )
+    return c
+
+# Rewritten code cannot be marshalled, because the comparison constants
+# are live objects; so they are swapped for placeholder strings before a
+# code object is saved, and swapped back when it is loaded.
+
+comparison_placeholders = tuple(
+    '<assay comparison {0}>'.format(name) for name in comparison_names
+)
+
+def replace_comparisons(c, old, new):
+    """Return a copy of a code object with constants `old` replaced by `new`.
+
+    Only a block of `old` at the very end of a code object's constants
+    is replaced, as that is where ``rewrite_asserts_in_code()`` puts the
+    comparison constants.
+
+    """
+    consts = tuple(
+        replace_comparisons(const, old, new)
+        if isinstance(const, types.CodeType) else const
+        for const in c.co_consts
     )
-    set_code(function, code_object)
+    n = len(old)
+    if len(consts) >= n and consts[-n:] == old:
+        consts = consts[:-n] + new
+    if consts == c.co_consts:
+        return c
+    return code_object_replace(c, c.co_code, consts, c.co_stacksize)
+
+def code_for_marshal(c):
+    """Prepare a rewritten code object for `marshal.dumps()`."""
+    return replace_comparisons(c, comparison_constants,
+                               comparison_placeholders)
+
+def code_from_marshal(c):
+    """Restore the comparisons to a code object from `marshal.loads()`."""
+    return replace_comparisons(c, comparison_placeholders,
+                               comparison_constants)
 
 def code_object_replace(c, new_code, new_consts, new_stacksize):
     """Emulate `.replace()` method for code objects in older Pythons."""
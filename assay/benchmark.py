@@ -1,10 +1,44 @@
 from time import time
+from assay.assertion import rewrite_bytecode, rewrite_bytecode_with_pattern
+from assay.samples import dots
 from assay.worker import Worker
 
 def dot():
     return '.'
 
+def large_test_function(statements, spacing):
+    """Return the code of a test with an assert every `spacing` lines."""
+    lines = ['def test_large(a, b):']
+    for i in range(statements):
+        if i % spacing == spacing - 1:
+            lines.append('    assert a[{0}] == b'.format(i))
+        else:
+            lines.append('    b = a.method({0}, b) + {0}'.format(i))
+    code = compile('\n'.join(lines), 'large.py', 'exec')
+    return [c for c in code.co_consts if hasattr(c, 'co_code')][0]
+
+def benchmark_assert_rewriting():
+    for statements, spacing in (1000, 4), (20000, 4), (20000, 200):
+        code = large_test_function(statements, spacing)
+        bytecode = code.co_code
+        offset = 0  # so the comparisons fit a one-byte operand
+        for name, rewrite in (
+                ('assert_pattern.sub()', rewrite_bytecode_with_pattern),
+                ('find_asserts()', rewrite_bytecode),
+        ):
+            n = 20
+            t0 = time()
+            for i in range(n):
+                result = rewrite(bytecode, offset)
+            dt = time() - t0
+            assert result[1] == statements // spacing
+            print('{0:,.6f} s = {1:,.1f} /s: Rewriting {2:,} asserts among'
+                  ' {3:,} lines with {4}'.format(dt / n, n / dt, result[1],
+                                                statements, name))
+
 def main():
+    benchmark_assert_rewriting()
+
     worker = Worker()
 
     n = 2000
@@ -28,6 +62,22 @@ def main():
     print('{0:,.6f} s = {1:,.1f} /s: Pushing, calling, popping a new worker'
           .format(dt / n, n / dt))
 
+    for n, size in (20000, 1), (2000, 10000):
+        t0 = time()
+        worker.start(dots, n, size)
+        count = 0
+        while True:
+            results = worker.receive()
+            if results and results[-1] is StopIteration:
+                count += len(results) - 1
+                break
+            count += len(results)
+        dt = time() - t0
+        assert count == n
+
+        print('{0:,.6f} s = {1:,.1f} /s: Streaming {2:,}-byte results'
+              ' from a generator'.format(dt / n, n / dt, size))
+
     worker.close()
 
 if __name__ == '__main__':
@@ -0,0 +1,56 @@
+"""A private directory where Assay keeps state between runs."""
+
+import hashlib
+import os
+import sys
+
+if sys.version_info >= (3,):
+    import pickle
+else:
+    import cPickle as pickle
+
+def cache_directory():
+    """Return the cache directory for the project in the current directory.
+
+    Each checkout gets its own subdirectory, named after a hash of its
+    path, beneath ``$XDG_CACHE_HOME/assay``.  The environment variable
+    ``ASSAY_CACHE_DIR`` overrides the location entirely.
+
+    """
+    path = os.environ.get('ASSAY_CACHE_DIR')
+    if path is None:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+            os.path.expanduser('~'), '.cache')
+        cwd = os.path.abspath(os.getcwd()).encode('utf-8')
+        digest = hashlib.sha1(cwd).hexdigest()[:16]
+        path = os.path.join(base, 'assay', digest)
+    return path
+
+def load(name, default):
+    """Return the object saved under `name`, or `default` if there is none."""
+    path = os.path.join(cache_directory(), name)
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        return default
+
+def save(name, value):
+    """Save `value` under `name`, replacing any previous value atomically.
+
+    Failure to save is not an error: a read-only home directory should
+    make Assay forgetful, not broken.
+
+    """
+    path = os.path.join(cache_directory(), name)
+    temporary_path = '{0}.{1}'.format(path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        pass  # it probably exists already
+    try:
+        with open(temporary_path, 'wb') as f:
+            pickle.dump(value, f, 2)
+        os.rename(temporary_path, path)
+    except (IOError, OSError):
+        pass
@@ -0,0 +1,168 @@
+"""Choose which combinations of fixture values a test should be run with.
+
+By default a test runs once for every combination in the product of
+its fixtures' values.  A `Strategy` instead chooses a smaller set of
+combinations, each given as a tuple of indexes into the value lists.
+
+"""
+import random
+from itertools import combinations, product
+
+class Strategy(object):
+    """A way of choosing combinations, parsed from a --cases argument.
+
+    The `name` is 'each' for every value at least once, 'wise' for a
+    covering array of strength `t` (so that every `t` values of
+    different fixtures appear together in some case), or 'random' for
+    a sample of `budget` combinations drawn with a random `seed`.
+
+    """
+    def __init__(self, name, t=None, budget=None, seed=None):
+        self.name = name
+        self.t = t
+        self.budget = budget
+        self.seed = seed
+
+    def choose(self, sizes):
+        """Return a list of index tuples, given the number of each value."""
+        if not all(sizes):
+            return []
+        if self.name == 'each':
+            return each_value(sizes)
+        if self.name == 'wise':
+            return covering_array(sizes, self.t)
+        return random_sample(sizes, self.budget, self.seed)
+
+    def description(self):
+        """Describe the strategy, in words and as a --cases argument."""
+        if self.name == 'each':
+            words = 'each value at least once'
+        elif self.name == 'wise':
+            words = ('pairwise' if self.t == 2 else '{0}-wise'.format(self.t))
+            words += ' coverage'
+        else:
+            words = 'random sampling with seed {0}'.format(self.seed)
+        return '{0}; rerun with --cases {1}'.format(words, self.argument())
+
+    def argument(self):
+        if self.name == 'each':
+            return 'each'
+        if self.name == 'wise':
+            return 'pairwise' if self.t == 2 else '{0}-wise'.format(self.t)
+        return 'random:{0}:{1}'.format(self.budget, self.seed)
+
+def parse_strategy(text):
+    """Parse a --cases argument, or raise ValueError.
+
+    >>> parse_strategy('3-wise').argument()
+    '3-wise'
+    >>> parse_strategy('random:50:7').argument()
+    'random:50:7'
+
+    """
+    if text == 'product':
+        return None
+    if text == 'each':
+        return Strategy('each')
+    if text == 'pairwise':
+        return Strategy('wise', t=2)
+    if text.endswith('-wise') and text[:-5].isdigit() and int(text[:-5]) > 0:
+        return Strategy('wise', t=int(text[:-5]))
+    fields = text.split(':')
+    if fields[0] == 'random' and len(fields) in (2, 3):
+        budget = int(fields[1])
+        if budget < 1:
+            raise ValueError('the random budget must be at least 1')
+        if len(fields) == 3:
+            seed = int(fields[2])
+        else:
+            seed = random.randrange(1000000)
+        return Strategy('random', budget=budget, seed=seed)
+    raise ValueError('unknown strategy {0!r}'.format(text))
+
+def each_value(sizes):
+    """Return the fewest cases that use every value at least once.
+
+    >>> each_value([2, 3])
+    [(0, 0), (1, 1), (0, 2)]
+
+    """
+    return [tuple(i % size for size in sizes) for i in range(max(sizes))]
+
+def covering_array(sizes, t):
+    """Return cases in which every `t` values of different fixtures meet.
+
+    Cases are built greedily: each starts from a combination that is
+    not yet covered, and then picks, fixture by fixture, the value that
+    covers the most further combinations.
+
+    >>> cases = covering_array([2, 2, 2], 2)
+    >>> len(cases)
+    4
+    >>> sorted(set((c[0], c[2]) for c in cases))
+    [(0, 0), (0, 1), (1, 0), (1, 1)]
+
+    """
+    n = len(sizes)
+    if t >= n:
+        return list(product(*[range(size) for size in sizes]))
+    # Generated in sorted order, so each case can start from the first
+    # group still uncovered without rescanning those already covered.
+    groups = [tuple(zip(fixtures, values))
+              for fixtures in combinations(range(n), t)
+              for values in product(*[range(sizes[i]) for i in fixtures])]
+    uncovered = set(groups)
+    cases = []
+    position = 0
+    while uncovered:
+        while groups[position] not in uncovered:
+            position += 1
+        case = dict(groups[position])
+        for i in range(n):
+            if i in case:
+                continue
+            others = sorted(case.items())
+            best_value = 0
+            best_count = -1
+            for value in range(sizes[i]):
+                count = 0
+                for rest in combinations(others, t - 1):
+                    if tuple(sorted(rest + ((i, value),))) in uncovered:
+                        count += 1
+                if count > best_count:
+                    best_value, best_count = value, count
+            case[i] = best_value
+        pairs = sorted(case.items())
+        for group in combinations(pairs, t):
+            uncovered.discard(group)
+        cases.append(tuple(value for i, value in pairs))
+    return cases
+
+def random_sample(sizes, budget, seed):
+    """Return `budget` distinct cases chosen at random, in product order.
+
+    >>> random_sample([2, 2], 10, 1)
+    [(0, 0), (0, 1), (1, 0), (1, 1)]
+
+    """
+    total = 1
+    for size in sizes:
+        total *= size
+    if budget < total:
+        # Drawn one by one, since the product may be far too large to
+        # list as a population.
+        generator = random.Random(seed)
+        chosen = set()
+        while len(chosen) < budget:
+            chosen.add(generator.randrange(total))
+        indexes = sorted(chosen)
+    else:
+        indexes = range(total)
+    cases = []
+    for index in indexes:
+        case = []
+        for size in reversed(sizes):
+            index, value = divmod(index, size)
+            case.append(value)
+        cases.append(tuple(reversed(case)))
+    return cases
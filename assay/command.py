@@ -5,7 +5,10 @@ from __future__ import print_function
 import argparse
 import os
 import sys
-from . import monitor, unix
+from . import cache, monitor, unix
+from .combinations import parse_strategy
+from .limits import Limits
+from .timeouts import Timeouts
 
 try:
     BrokenPipeError
@@ -13,18 +16,88 @@ except NameError:
     BrokenPipeError = ()  # do not bother catching it under Python 2
 
 def main():
-    os.environ['PYTHONDONTWRITEBYTECODE'] = 'please'
-    sys.dont_write_bytecode = True
+    if sys.version_info >= (3, 8):
+        # Keep bytecode in a private directory outside the source tree,
+        # where no stray .pyc can outlive its .py and keep a deleted
+        # module importable; our workers and their children inherit it.
+        prefix = os.path.join(cache.cache_directory(), 'pycache')
+        os.environ['PYTHONPYCACHEPREFIX'] = prefix
+        sys.pycache_prefix = prefix
+    else:
+        os.environ['PYTHONDONTWRITEBYTECODE'] = 'please'
+        sys.dont_write_bytecode = True
     parser = argparse.ArgumentParser(prog='assay')
     parser.description = 'Fast testing framework'
     parser.add_argument('name', nargs='+',
         help='directory, package, or module to test')
     parser.add_argument('--batch', action='store_true',
         help='run tests once, then exit with success or failure')
+    parser.add_argument('--preload', action='append', default=[],
+        metavar='MODULES',
+        help='comma-separated modules for each worker to import once,'
+        ' before forking to run tests; repeat to stack further levels')
+    parser.add_argument('--cached', action='store_true',
+        help='replay the results of test modules whose code, and the code'
+        ' they import, has not changed since they last passed')
+    parser.add_argument('--workers', type=int, metavar='N',
+        help='number of worker processes (default: one per usable CPU)')
+    parser.add_argument('--gc-threshold', metavar='N[,N[,N]]',
+        help='garbage collection thresholds for the processes that run'
+        ' tests, as for gc.set_threshold(); 0 disables collection')
+    parser.add_argument('--timeout', type=float, metavar='SECONDS',
+        help='kill any test that runs longer than this')
+    parser.add_argument('--module-timeout', type=float, metavar='SECONDS',
+        help='kill a worker that spends longer than this on one job'
+        ' (importing a module, or running a batch of its tests)')
+    parser.add_argument('--isolate', action='store_true',
+        help='run each test in a fork of the process that built its'
+        ' fixtures, so tests that change a fixture cannot affect others')
+    parser.add_argument('--cases', default='product', metavar='STRATEGY',
+        help='which combinations of fixture values to run: product (all),'
+        ' each (every value at least once), pairwise, N-wise, or'
+        ' random:BUDGET[:SEED]')
+    parser.add_argument('--limit-memory', type=float, metavar='MB',
+        help='limit the address space of each process that runs tests')
+    parser.add_argument('--limit-cpu', type=int, metavar='SECONDS',
+        help='limit the CPU time of each job in a process that runs tests')
+    parser.add_argument('--limit-files', type=int, metavar='N',
+        help='limit the open files of each process that runs tests')
+    parser.add_argument('--recycle-modules', type=int, metavar='N',
+        help='replace a process that runs tests once it has imported'
+        ' this many test modules')
+    parser.add_argument('--recycle-rss', type=float, metavar='MB',
+        help='replace a process that runs tests once its resident'
+        ' memory exceeds this')
     args = parser.parse_args()
+    if args.workers is not None and args.workers < 1:
+        parser.error('--workers must be at least 1')
+    preload = [names.split(',') for names in args.preload]
+    try:
+        strategy = parse_strategy(args.cases)
+    except ValueError as e:
+        parser.error('--cases: {0}'.format(e))
+    megabyte = 1024 * 1024
+    limits = Limits(
+        None if args.limit_memory is None else args.limit_memory * megabyte,
+        args.limit_cpu,
+        args.limit_files,
+        args.recycle_modules,
+        None if args.recycle_rss is None else args.recycle_rss * megabyte,
+    )
+    gc_threshold = None
+    if args.gc_threshold is not None:
+        try:
+            gc_threshold = tuple(int(n) for n in args.gc_threshold.split(','))
+        except ValueError:
+            parser.error('--gc-threshold must be up to three integers')
+        if not 1 <= len(gc_threshold) <= 3:
+            parser.error('--gc-threshold must be up to three integers')
     try:
         with unix.configure_tty() as isatty:
-            monitor.main_loop(args.name, args.batch or not isatty)
+            monitor.main_loop(args.name, args.batch or not isatty, preload,
+                              args.cached, args.workers, gc_threshold,
+                              Timeouts(args.timeout, args.module_timeout),
+                              limits, args.isolate, strategy)
     except monitor.Restart:
         print()
         print(' Restart '.center(79, '='))
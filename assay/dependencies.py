@@ -0,0 +1,72 @@
+"""Work out which test modules a change to a source file might affect."""
+
+class Dependencies(object):
+    """A reverse index of which modules are imported by which.
+
+    The workers report what each module imported, and `update()` turns
+    that around into a dictionary mapping each module to the modules
+    that import it.  Given a list of changed paths, `affected()` then
+    follows the index from the modules at those paths to the test
+    modules that import them, whether directly or through any number of
+    other modules.
+
+    """
+    def __init__(self):
+        self.importers = {}             # module name -> names importing it
+        self.imports = {}               # module name -> names it imports
+        self.paths = {}                 # path -> module names
+        self.files = {}                 # module name -> path
+        self.test_module_names = set()
+        self.unsettled = set()          # test modules to rerun regardless
+
+    def update(self, module_paths, import_graph):
+        """Learn from a worker's `list_module_paths()` and `import_graph()`."""
+        paths = self.paths
+        files = self.files
+        for name, path in module_paths:
+            paths.setdefault(path, set()).add(name)
+            files[name] = path
+        importers = self.importers
+        imports = self.imports
+        for importer, names in import_graph.items():
+            imports.setdefault(importer, set()).update(names)
+            for name in names:
+                importers.setdefault(name, set()).add(importer)
+
+    def add_paths(self, module_name, paths):
+        """Note that a module depends on `paths`, without knowing how.
+
+        This lets a test module whose results were replayed from a
+        cache, and which therefore never ran, be rerun when one of the
+        files that it imported last time is changed.
+
+        """
+        for path in paths:
+            self.paths.setdefault(path, set()).add(module_name)
+
+    def affected(self, changed_paths):
+        """Return the names of the test modules that `changed_paths` affect."""
+        stack = []
+        for path in changed_paths:
+            stack.extend(self.paths.get(path, ()))
+        seen = set(stack)
+        importers = self.importers
+        while stack:
+            for importer in importers.get(stack.pop(), ()):
+                if importer not in seen:
+                    seen.add(importer)
+                    stack.append(importer)
+        return seen & self.test_module_names
+
+    def paths_imported_by(self, module_name):
+        """Return the paths of a module and of everything it imports."""
+        stack = [module_name]
+        seen = set(stack)
+        imports = self.imports
+        while stack:
+            for name in imports.get(stack.pop(), ()):
+                if name not in seen:
+                    seen.add(name)
+                    stack.append(name)
+        files = self.files
+        return set(files[name] for name in seen if name in files)
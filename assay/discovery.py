@@ -37,11 +37,19 @@ def interpret_argument(worker, name):
     exit(1)
 
 def search_argument(import_directory, import_name):
-    """Given a tuple returned by `interpret_argument()`, find tests."""
+    """Given a tuple returned by `interpret_argument()`, find tests.
+
+    Returns a list of ``(module_name, path)`` tuples, whose path is the
+    module's source file, or None if the module has none.
+
+    """
     if import_directory is not None:
         sys.path.insert(0, import_directory)
     package_directory = get_directory_of(import_name)
-    names = [import_name]
+    path = getattr(sys.modules.get(import_name), '__file__', None)
+    if path is not None:
+        path = os.path.abspath(path.rstrip('co'))  # in case of .pyc or .pyo
+    names = [(import_name, path)]
     if package_directory is not None:
         # TODO: make this recursive; tried to use os.walk(), but it looks
         # a bit awkward for this - makes us keep re-discovering where we are.
@@ -51,7 +59,9 @@ def search_argument(import_directory, import_name):
             module_name = module_name_of(filename)
             if not module_name:
                 continue
-            names.append(import_name + '.' + module_name)
+            names.append((import_name + '.' + module_name,
+                          os.path.abspath(os.path.join(package_directory,
+                                                       filename))))
     return names
 
 def _discover_enclosing_packages(directory, names):
@@ -0,0 +1,85 @@
+"""Remember how long tests took, so the next run can schedule them well."""
+
+from . import cache
+
+class History(object):
+    """Durations of module imports and of tests, saved between runs.
+
+    Durations are kept in a dictionary that maps each module name to a
+    dictionary of test names and their durations in seconds, where the
+    test name None stands for the time it took to import the module
+    and list its tests.
+
+    The seconds that each scoped fixture took to set up are kept in a
+    second dictionary, `fixture_costs`, under the fixture's key.
+
+    """
+    filename = 'durations.pickle'
+    fixture_filename = 'fixture_costs.pickle'
+
+    def __init__(self, durations=None, fixture_costs=None):
+        self.durations = {} if durations is None else durations
+        self.fixture_costs = {} if fixture_costs is None else fixture_costs
+
+    @classmethod
+    def load(cls):
+        return cls(cache.load(cls.filename, None),
+                   cache.load(cls.fixture_filename, None))
+
+    def save(self):
+        cache.save(self.filename, self.durations)
+        cache.save(self.fixture_filename, self.fixture_costs)
+
+    def record_listing(self, module_name, test_names, seconds):
+        """Record an import, and forget tests that no longer exist."""
+        old = self.durations.get(module_name, {})
+        new = dict((name, old[name]) for name in test_names if name in old)
+        new[None] = seconds
+        self.durations[module_name] = new
+
+    def record(self, module_name, test_name, seconds):
+        self.durations.setdefault(module_name, {})[test_name] = seconds
+
+    def record_fixture_costs(self, setup_seconds):
+        """Record how long fixtures took to set up, given a dictionary."""
+        self.fixture_costs.update(setup_seconds)
+
+    def fixture_cost(self, key):
+        """Return how long a fixture takes to set up, or 0.0 if unknown."""
+        return self.fixture_costs.get(key, 0.0)
+
+    def estimate(self, module_name):
+        """Return how long a module should take, or None if it is new."""
+        tests = self.durations.get(module_name)
+        if not tests or None not in tests:
+            return None
+        return sum(tests.values())
+
+    def weights(self, module_name, test_names, case_counts=None):
+        """Return an estimated duration for each of the named tests.
+
+        Tests that have never been timed are assumed to take as long as
+        the average of their module's other tests, for each of the cases
+        that `case_counts` says they have.
+
+        """
+        tests = self.durations.get(module_name, {})
+        known = [tests[name] for name in test_names if name in tests]
+        default = sum(known) / len(known) if known else 1.0
+        case_counts = case_counts or {}
+        return [tests[name] if name in tests
+                else default * case_counts.get(name, 1)
+                for name in test_names]
+
+def longest_first(module_names, history):
+    """Order modules so that popping from the end yields the longest first.
+
+    Modules that have never been timed are popped before all others,
+    in their original relative order, since they might be slow and
+    since their author is probably waiting to see them run.
+
+    """
+    def key(name):
+        seconds = history.estimate(name)
+        return (1, 0.0) if seconds is None else (0, seconds)
+    return sorted(module_names, key=key)
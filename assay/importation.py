@@ -1,6 +1,7 @@
 """Routines that understand Python importation."""
 
 import sys
+import threading
 
 if sys.version_info >= (2, 7):
     from importlib import import_module
@@ -8,12 +9,25 @@ else:
     from functools import partial  # to avoid creating a stack frame
     import_module = partial(__import__, fromlist=['__file__'], level=0)
 
+if sys.version_info >= (3,):
+    import builtins
+else:
+    import __builtin__ as builtins
+
+_original_import = builtins.__import__
+_default_level = 0 if sys.version_info >= (3,) else -1
+_import_graph = {}
+_changed_importers = set()      # importers with new edges since last taken
+_taken_names = set()            # modules whose paths have been taken
+
+STARTED_A_THREAD = 'import started a thread'
+
 def get_directory_of(name):
     """Return the base directory of a package, or None for a plain module."""
     module = import_module(name)
     return getattr(module, '__path__', (None,))[0]
 
-def import_modules(module_names):
+def import_modules(module_names, failures=None):
     """Import the modules listed in `modules_names` and record what happens.
 
     The return value is a list of ``(module_name, module_set)`` tuples
@@ -27,19 +41,104 @@ def import_modules(module_names):
 
     This list can then become the input to ``improve_order()``.
 
+    Modules that cannot be imported are skipped.  If a `failures` list
+    is provided, then a tuple ``(module_name, message)`` is appended to
+    it for each such module, and also for each module that starts a
+    thread when imported, since threads do not survive a fork.
+
     """
     old = set(name for name, m in sys.modules.items() if m is not None)
     import_events = []
     for module_name in module_names:
+        thread_count = threading.active_count()
         try:
             import_module(module_name)
-        except ImportError:
+        except Exception as e:
+            if failures is not None:
+                message = '{0}: {1}'.format(type(e).__name__, e)
+                failures.append((module_name, message))
             continue
+        if failures is not None and threading.active_count() > thread_count:
+            failures.append((module_name, STARTED_A_THREAD))
         new = set(name for name, m in sys.modules.items() if m is not None)
         import_events.append((module_name, new - old))
         old = new
     return import_events
 
+def preload_modules(module_names):
+    """Import modules ahead of time, in a process that will later fork.
+
+    Returns a tuple ``(paths, import_events, failures)`` giving the
+    paths of the modules newly imported, the events described by
+    ``import_modules()``, and the failures that it reported.
+
+    """
+    old = set(sys.modules)
+    failures = []
+    import_events = import_modules(module_names, failures)
+    paths = [path for name, path in list_module_paths() if name not in old]
+    return paths, import_events, failures
+
+def record_imports():
+    """Start recording, for each module, the names of the modules it imports.
+
+    The import statement is routed through our own `__import__()`,
+    which notes every import, including imports of modules that have
+    already been imported elsewhere.
+
+    """
+    builtins.__import__ = _recording_import
+
+def _recording_import(name, globals=None, locals=None, fromlist=(),
+                      level=_default_level):
+    module = _original_import(name, globals, locals, fromlist, level)
+    importer = globals.get('__name__') if globals else None
+    if importer is not None:
+        names = _import_graph.get(importer)
+        if names is None:
+            names = _import_graph[importer] = set()
+        if fromlist:
+            target = module.__name__
+            modules = sys.modules
+            for item in fromlist:
+                submodule_name = '{0}.{1}'.format(target, item)
+                if submodule_name in modules:
+                    names.add(submodule_name)
+        else:
+            target = name
+        if target not in names:
+            names.add(target)
+            _changed_importers.add(importer)
+    return module
+
+def import_graph():
+    """Return a dict mapping module names to the module names they import.
+
+    A copy is returned, since pickling the graph can import modules,
+    which would otherwise change the graph while it is being pickled.
+
+    """
+    return dict((name, set(names)) for name, names
+                in list(_import_graph.items()))
+
+def take_new_imports():
+    """Return what this process has imported since it was last asked.
+
+    The return value is a tuple ``(module_paths, graph)``, like the
+    results of ``list_module_paths()`` and ``import_graph()`` but
+    listing only modules imported since the last call, and only the
+    importers that have imported something new since then.  The first
+    call in a process returns everything.
+
+    """
+    module_paths = [(name, path) for name, path in list_module_paths()
+                    if name not in _taken_names]
+    _taken_names.update(name for name, path in module_paths)
+    importers = list(_changed_importers)
+    _changed_importers.clear()
+    graph = dict((name, set(_import_graph[name])) for name in importers)
+    return module_paths, graph
+
 def list_module_paths():
     items = list(sys.modules.items())
     return [(name, module.__file__) for name, module in items
@@ -0,0 +1,66 @@
+"""Limit the resources of test processes, and replace those that grow."""
+
+import math
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+class Limits(object):
+    """Resource limits for each process that runs tests, and its lifespan.
+
+    The `memory` limit, in bytes, is on address space; `cpu_seconds`
+    is allowed to each job, counting from when the job starts; and
+    `open_files` limits file descriptors.  A process is replaced by a fresh one, between jobs,
+    once it has imported `module_count` test modules or once its
+    resident memory has grown past `rss` bytes.  Any value can be None.
+
+    """
+    def __init__(self, memory=None, cpu_seconds=None, open_files=None,
+                 module_count=None, rss=None):
+        self.memory = memory
+        self.cpu_seconds = cpu_seconds
+        self.open_files = open_files
+        self.module_count = module_count
+        self.rss = rss
+
+    def rlimits(self):
+        """Return a list of ``(resource, value)`` pairs to set."""
+        if resource is None:
+            return []
+        pairs = [(resource.RLIMIT_AS, self.memory),
+                 (resource.RLIMIT_CPU, self.cpu_seconds),
+                 (resource.RLIMIT_NOFILE, self.open_files)]
+        return [(which, int(value)) for which, value in pairs
+                if value is not None]
+
+    def job_rlimits(self):
+        """Return the pairs from `rlimits()` to set again before each job."""
+        if resource is None:
+            return []
+        return [(which, value) for which, value in self.rlimits()
+                if which == resource.RLIMIT_CPU]
+
+    def is_worn_out(self, module_count, rss):
+        """Return whether a process should be replaced before its next job."""
+        if self.module_count is not None and module_count >= self.module_count:
+            return True
+        return self.rss is not None and rss is not None and rss > self.rss
+
+def set_rlimits(rlimits):
+    """In a worker, lower the soft limits given by `Limits.rlimits()`.
+
+    A CPU limit is counted from now, by adding the CPU time that the
+    process has already used.  A limit cannot be raised above the hard
+    limit, so a larger value is lowered to match it.
+
+    """
+    for which, value in rlimits:
+        if which == resource.RLIMIT_CPU:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            value += int(math.ceil(usage.ru_utime + usage.ru_stime))
+        soft, hard = resource.getrlimit(which)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        resource.setrlimit(which, (value, hard))
@@ -2,15 +2,29 @@
 
 from __future__ import print_function
 
+import gc
 import os
 import sys
+import tempfile
+from time import time
 from . import unix
 from .discovery import interpret_argument, search_argument
 from .filesystem import Filesystem
+from .history import History
+from .preloading import LearnedOrder, Levels
+from .dependencies import Dependencies
 from .importation import list_module_paths
+from .limits import Limits, set_rlimits
+from .replay import ResultCache
 from .reporting import BatchReporter, InteractiveReporter
-from .runner import capture_stdout_stderr, run_tests_of
-from .worker import Worker
+from .runner import (Fixtures, Imports, Teardown, Timing,
+                     capture_stdout_stderr, clear_fixture_cache,
+                     describe_test_item, list_tests_of, report_imports,
+                     run_tests_of, split_test_item)
+from .scheduler import Scheduler
+from .timeouts import (Timeouts, dump_stack, enable_stack_dumps,
+                       parse_stack, read_stack_file)
+from .worker import ExitPipe, Worker, launch_workers
 
 class Restart(BaseException):
     """Tell ``main()`` that we need to restart."""
@@ -19,6 +33,7 @@ python3 = sys.version_info >= (3,)
 stdin_fd = sys.stdin.fileno()
 stdout_fd = sys.stdout.fileno()
 ctrl_d = b'\x04'
+memory_per_worker = 256 * 1024 * 1024
 
 def read_keystrokes():
     """Read user keystrokes from standard input."""
@@ -34,9 +49,26 @@ def write(string):
     # characters.
     os.write(stdout_fd, string.encode('utf-8'))
 
-def main_loop(arguments, batch_mode):
-    """Run and report on tests while also letting the user type commands."""
+def main_loop(arguments, batch_mode, preload=(), cached=False,
+              worker_count=None, gc_threshold=None, timeouts=None,
+              limits=None, isolated=False, strategy=None):
+    """Run and report on tests while also letting the user type commands.
 
+    Each item of `preload` is a list of module names, that are imported
+    in each worker as a level of its own before any tests are run.  If
+    `cached` is true, then test modules whose code has not changed since
+    they last passed are not run; their results are replayed instead.
+    The `worker_count` defaults to what ``default_worker_count()`` says.
+    A `gc_threshold` tuple is passed to ``gc.set_threshold()`` in each
+    worker, and so governs the test processes that it forks.  Tests
+    that exceed the limits of a `timeouts` object are killed, and the
+    processes that run tests are constrained by a `limits` object.
+    If `isolated` is true, each test runs in a process of its own.  A
+    `strategy` chooses which combinations of fixture values to run.
+
+    """
+
+    t0 = time()
     main_process_paths = set(path for name, path in list_module_paths())
 
     poller = unix.EPoll()
@@ -50,30 +82,67 @@ def main_loop(arguments, batch_mode):
         reporter_class = InteractiveReporter
         poller.register(sys.stdin)
 
+    if timeouts is None:
+        timeouts = Timeouts()
     runner = None  # so our 'finally' clause does not explode
     workers = []
+    stack_paths = {}
     try:
-        for i in range(unix.cpu_count()):
-            worker = Worker()
-            workers.append(worker)
+        if worker_count is None:
+            worker_count = default_worker_count()
+        workers.extend(launch_workers(worker_count))
+        for worker in workers:
             poller.register(worker)
+            poller.register(worker.exit_pipe)
+            if gc_threshold is not None:
+                worker.call(gc.set_threshold, *gc_threshold)
+            fd, stack_paths[worker] = tempfile.mkstemp(prefix='assay-stack-')
+            os.close(fd)
+            worker.call(enable_stack_dumps, stack_paths[worker])
 
-        paths_under_test = set()
-        reporter = reporter_class(write)
-        runner = runner_coroutine(arguments, workers, reporter,
-                                  paths_under_test)
-        next(runner)
+        learned = LearnedOrder.load()
+        levels = Levels(workers, preload, write, learned)
+        levels.push()
+
+        history = History.load()
+        dependencies = Dependencies()
+
+        def start_runner(only, t0=None):
+            """Start a run; return its reporter, runner, and if it finished."""
+            reporter = reporter_class(write, t0)
+            result_cache = None
+            if cached:
+                variant = '' if strategy is None else strategy.argument()
+                result_cache = ResultCache.load(variant)
+            runner = runner_coroutine(arguments, workers, reporter, history,
+                                      learned, dependencies, only,
+                                      result_cache, timeouts, stack_paths,
+                                      limits, isolated, strategy)
+            try:
+                next(runner)
+            except StopIteration:
+                finish(reporter)  # there were no tests left to run
+                return reporter, runner, True
+            return reporter, runner, False
 
-        for source, flags in poller.events():
+        def finish(reporter):
+            if batch_mode:
+                exit(1 if reporter.errors else 0)
+            file_watcher.add_paths(dependencies.paths)
 
-            if isinstance(source, Worker):
+        # The first run is timed from when Assay started, so that its
+        # time to first result includes launching the workers.
+        only = None
+        reporter, runner, finished = start_runner(only, t0)
+
+        for source, flags in poller.events(timeouts.seconds_left):
+
+            if source is None or isinstance(source, (Worker, ExitPipe)):
                 try:
                     runner.send(source)
                 except StopIteration:
-                    if batch_mode:
-                        exit(1 if reporter.errors else 0)
-                    file_watcher.add_paths(paths_under_test)
-                    #write('Watching {0} paths...'.format(len(paths_under_test)))
+                    finish(reporter)
+                    finished = True
 
             elif source is sys.stdin:
                 for keystroke in read_keystrokes():
@@ -82,6 +151,11 @@ def main_loop(arguments, batch_mode):
                         sys.exit(0)
                     elif keystroke == b'r':
                         raise Restart()
+                    elif keystroke == b'a':
+                        runner.close()
+                        write('\n\nRunning all tests\n\n')
+                        only = None
+                        reporter, runner, finished = start_runner(only)
                     else:
                         reporter.process_keystroke(keystroke)
 
@@ -99,41 +173,262 @@ def main_loop(arguments, batch_mode):
                 if paths:
                     write('\n\nFile modified: {0}\n\n'.format(paths[0]))
 
-                paths_under_test = set()
-                reporter = reporter_class(write)
-                runner = runner_coroutine(arguments, workers, reporter,
-                                          paths_under_test)
-                next(runner)
+                if levels.invalidate(paths):
+                    levels.push()
 
-            # import_order = improve_order(import_order, dangers)
-            # module_paths, events = worker(import_modules, import_order)
+                # Run only the tests affected by the change; plus, if
+                # the previous run was interrupted, all of its tests.
+                affected = dependencies.affected(paths)
+                if finished:
+                    only = affected
+                elif only is not None:
+                    only = only | affected
+                reporter, runner, finished = start_runner(only)
     finally:
         if runner is not None:
             runner.close()
         for worker in workers:
             worker.close()
+        for path in stack_paths.values():
+            os.unlink(path)
+
+def default_worker_count():
+    """Return how many workers this machine, or container, can support.
+
+    This is one per usable CPU, but no more than the available memory
+    can hold at `memory_per_worker` bytes apiece.
 
-def runner_coroutine(arguments, workers, reporter, paths_under_test):
+    """
+    count = unix.cpu_count()
+    memory = unix.available_memory()
+    if memory is not None:
+        count = min(count, memory // memory_per_worker)
+    return max(1, count)
+
+def runner_coroutine(arguments, workers, reporter, history, learned,
+                     dependencies, only=None, result_cache=None,
+                     timeouts=None, stack_paths=None, limits=None,
+                     isolated=False, strategy=None):
+    """Run tests, receiving each worker that has results ready via `send()`.
+
+    Sending None instead of a worker asks the runner to check its
+    `timeouts`: a worker whose test has run too long has its process
+    killed, and replaced with a fresh one, after the stack of the stuck
+    test is read using the worker's file in `stack_paths`.  Sending a
+    worker's `exit_pipe` tells the runner that the worker's process
+    might have crashed, so that it too can be reported and replaced.
+
+    Each process that runs tests is subject to the resource `limits`,
+    which also say when a process has grown enough to be replaced.
+    If `isolated` is true, each test is run in a fork of the process
+    that built its fixtures, so that it cannot change them for others.
+    A `strategy` is passed along to ``run_tests_of()``.
+
+    If `only` is a set of module names, then only those test modules are
+    run, together with any test modules that were not seen last time,
+    and any that last time failed or were not seen to finish a job.
+    If a `result_cache` is provided, modules with cached results are not
+    run, and modules that pass are added to the cache.
+
+    """
     worker = workers[0]
     running_workers = set()
+    idle_workers = set()
     names = []
 
     for argument in arguments:
         import_path, import_name = interpret_argument(worker, argument)
-        more_names = search_argument(import_path, import_name)
-        names.extend(more_names)
+        for name, path in search_argument(import_path, import_name):
+            names.append(name)
+            # Known from the start, so that a test module that cannot
+            # even be imported is rerun once its file is fixed.
+            if path is not None:
+                dependencies.add_paths(name, [path])
+
+    known_names = dependencies.test_module_names
+    dependencies.test_module_names = set(names)
+    if only is not None:
+        unsettled = dependencies.unsettled
+        names = [name for name in names if name in only
+                 or name in unsettled or name not in known_names]
+
+    if result_cache is not None:
+        uncached_names = []
+        for name in names:
+            results = result_cache.lookup(name)
+            if results is None:
+                uncached_names.append(name)
+            else:
+                reporter.report_results(results)
+                dependencies.add_paths(name, result_cache.manifest[name])
+        names = uncached_names
+
+    scheduler = Scheduler(names, len(workers), history)
+    test_module_names = set(names)
+    jobs = {}
+    start_times = {}
+    module_results = dict((name, []) for name in names)
+    memory_usages = {}
+    peak_rss = {}
+    fixture_counts = [0, 0]  # hits, misses
+    fork_totals = [0, 0.0]  # forks, seconds of overhead
+    case_counts = {}        # module name -> cases of parametrized tests
+    fixture_uses = {}       # module name -> scoped fixtures of its tests
+    range_seconds = {}      # (module name, test name) -> seconds so far
+    tests_finished = {}
+    stack_sizes = {}
+    observed_names = set()  # modules whose imports a finished job reported
+    if timeouts is None:
+        timeouts = Timeouts()
+    if limits is None:
+        limits = Limits()
+    rlimits = limits.rlimits()
+    job_rlimits = limits.job_rlimits()
+
+    def start_process(worker):
+        worker.push()
+        if rlimits:
+            worker.call(set_rlimits, rlimits)
 
     def give_work_to(worker):
-        if names:
-            name = names.pop()
-            worker.start(capture_stdout_stderr, run_tests_of, name)
+        job = scheduler.next_job(worker)
+        if job is not None:
+            jobs[worker] = job
+            start_times[worker] = time()
+            tests_finished[worker] = 0
+            if job_rlimits:
+                worker.call(set_rlimits, job_rlimits)
+            timeouts.start(worker)
+            if stack_paths:
+                stack_sizes[worker] = os.path.getsize(stack_paths[worker])
+            module_name, test_names = job
+            if test_names is None:
+                several = len(workers) > 1
+                count_cases = ()
+                if several:
+                    count_cases = scheduler.tests_worth_counting(module_name)
+                worker.start(capture_stdout_stderr, report_imports,
+                             list_tests_of, module_name,
+                             count_cases=count_cases, strategy=strategy,
+                             find_fixtures=several)
+            else:
+                worker.start(capture_stdout_stderr, report_imports,
+                             run_tests_of, module_name, test_names,
+                             timed=True, isolated=isolated,
+                             strategy=strategy)
         else:
+            jobs.pop(worker, None)
+            timeouts.stop(worker)
+            if any(test_names is None for module_name, test_names
+                   in jobs.values()):
+                # Wait, in case the module being listed has a chunk to spare.
+                idle_workers.add(worker)
+                return
             running_workers.remove(worker)
-            paths = [path for name, path in worker.call(list_module_paths)]
-            paths_under_test.update(paths)
+            memory_usages[worker] = unix.memory_usage(worker.pids[-1])
+            clear_fixtures(worker)
+
+    def wake_idle_workers():
+        for worker in list(idle_workers):
+            idle_workers.remove(worker)
+            give_work_to(worker)
+
+    def clear_fixtures(worker):
+        """Tear down the fixtures that a process has cached."""
+        failures = worker.call(clear_fixture_cache)
+        hits, misses = failures.pop()
+        fixture_counts[0] += hits
+        fixture_counts[1] += misses
+        reporter.report_results([file_teardown(failure)
+                                 for failure in failures])
+
+    def file_teardown(result):
+        """Unwrap a `Teardown`, filing its failure under its own module."""
+        if isinstance(result, Teardown):
+            module_results.setdefault(result.module_name, []).append(
+                result.failure)
+            return result.failure
+        return result
+
+    def finish_job(worker):
+        """Measure the process that ran a job, and maybe replace it."""
+        rss = None
+        sizes = unix.resident_memory(worker.pids[-1])
+        if sizes is not None:
+            rss, peak = sizes
+            peak_rss[worker] = max(peak, peak_rss.get(worker, 0))
+        module_count = len(scheduler.imported.get(worker, ()))
+        if limits.is_worn_out(module_count, rss):
+            clear_fixtures(worker)
+            worker.pop()
+            start_process(worker)
+            scheduler.forget_imports(worker)
+        give_work_to(worker)
+        wake_idle_workers()
+
+    def time_out(worker, seconds):
+        frames = dump_stack(worker.pids[-1], stack_paths[worker])
+        worker.pop()
+        explanation = 'took more than {0} seconds'.format(seconds)
+        return abandon_job(worker, 'T', 'Timeout', explanation, frames)
+
+    def crash(worker, status):
+        frames = []
+        if stack_paths:
+            path = stack_paths[worker]
+            frames = parse_stack(read_stack_file(path, stack_sizes[worker]))
+        explanation = 'crashed ({0})'.format(unix.describe_exit(status))
+        return abandon_job(worker, 'C', 'Crash', explanation, frames)
+
+    def abandon_job(worker, letter, error_name, explanation, frames):
+        """Report the test that killed a worker's process, and start over.
+
+        The test is the one that `frames` say the process was running,
+        or else the first whose results had not arrived.  Any others
+        whose results had not arrived are run again by a new process.
+
+        As a crash can come so quickly that the results of the tests
+        before it are still waiting to be sent, a crash that `frames`
+        cannot pin on a test is not reported; instead, each unfinished
+        test is requeued by itself, so that the culprit crashes alone.
+
+        """
+        module_name, test_names = jobs[worker]
+        start_process(worker)
+        if test_names is None:
+            test_name = None
+            message = 'importing {0} {1}'.format(module_name, explanation)
+            remaining = None
+        else:
+            unfinished = test_names[tests_finished[worker]:]
+            culprit = None
+            for filename, lineno, name, line in frames[:1]:
+                for item in unfinished:
+                    if split_test_item(item)[0] == name:
+                        culprit = item
+                        break
+            if culprit is None and letter == 'C' and len(unfinished) > 1:
+                for item in reversed(unfinished):
+                    scheduler.requeue(worker, module_name, [item])
+                give_work_to(worker)
+                wake_idle_workers()
+                return None
+            if culprit is None:
+                culprit = unfinished[0]
+            test_name = split_test_item(culprit)[0]
+            message = '{0} {1}'.format(describe_test_item(culprit),
+                                       explanation)
+            remaining = [item for item in unfinished if item != culprit]
+        result = (letter, error_name, message, frames)
+        module_results[module_name].append(result)
+        history.record(module_name, test_name, time() - start_times[worker])
+        scheduler.requeue(worker, module_name, remaining)
+        give_work_to(worker)
+        wake_idle_workers()
+        return result
 
     for worker in workers:
-        worker.push()
+        start_process(worker)
 
     try:
         for worker in workers:
@@ -142,14 +437,112 @@ def runner_coroutine(arguments, workers, reporter, paths_under_test):
 
         while running_workers:
             worker = yield
-            result = worker.next()
-            if result is StopIteration:
-                give_work_to(worker)
+            results = []
+            if worker is None:
+                for worker, seconds in timeouts.expired():
+                    results.append(time_out(worker, seconds))
+                reporter.report_results(results)
+                continue
+            status = None
+            if isinstance(worker, ExitPipe):
+                worker = worker.worker
+                exit = worker.reap()
+                if exit is None:
+                    continue
+                status, messages = exit
             else:
-                reporter.report_result(result)
+                messages = worker.receive()
+            for result in messages:
+                if result is StopIteration:
+                    if status is None:
+                        finish_job(worker)
+                    else:
+                        # The process finished its job before it died.
+                        start_process(worker)
+                        scheduler.forget_imports(worker)
+                        status = None
+                        give_work_to(worker)
+                        wake_idle_workers()
+                elif isinstance(result, Timing):
+                    module_name, test_names = jobs[worker]
+                    item = test_names[tests_finished[worker]]
+                    name, cases = split_test_item(item)
+                    seconds = result.seconds
+                    if cases is not None:
+                        # Remember the sum of the ranges run so far.
+                        key = module_name, name
+                        seconds += range_seconds.get(key, 0.0)
+                        range_seconds[key] = seconds
+                    history.record(module_name, name, seconds)
+                    tests_finished[worker] += 1
+                    timeouts.progress(worker)
+                    fork_totals[0] += result.forks
+                    fork_totals[1] += result.fork_seconds
+                    history.record_fixture_costs(result.fixture_seconds)
+                elif isinstance(result, Fixtures):
+                    module_name, test_names = jobs[worker]
+                    fixture_uses[module_name] = result.uses
+                    history.record_fixture_costs(result.setup_seconds)
+                elif isinstance(result, list):
+                    module_name, test_names = jobs[worker]
+                    seconds = time() - start_times[worker]
+                    history.record_listing(module_name, result, seconds)
+                    scheduler.split(module_name, result,
+                                    case_counts.get(module_name),
+                                    fixture_uses.get(module_name))
+                    wake_idle_workers()
+                elif isinstance(result, dict):
+                    module_name, test_names = jobs[worker]
+                    case_counts[module_name] = result
+                elif isinstance(result, Imports):
+                    # Each job reports its imports as it finishes, since
+                    # its process might later crash and lose them.
+                    module_paths = result.module_paths
+                    dependencies.update(module_paths, result.graph)
+                    learned.observe(module_paths, test_module_names)
+                    observed_names.update(name for name, path
+                                          in module_paths)
+                elif isinstance(result, Teardown):
+                    results.append(file_teardown(result))
+                else:
+                    module_name, test_names = jobs[worker]
+                    module_results[module_name].append(result)
+                    results.append(result)
+            if status is not None and worker in jobs:
+                result = crash(worker, status)
+                if result is not None:
+                    results.append(result)
+            reporter.report_results(results)
 
     finally:
         for worker in workers:
             worker.pop()
 
+    # Without a clean pass whose imports were all seen, a module cannot
+    # be trusted to be affected only by changes to the paths it imported.
+    dependencies.unsettled = set(
+        name for name, results in module_results.items()
+        if name not in observed_names
+        or not all(result == '.' for result in results))
+
+    if result_cache is not None:
+        for name, results in module_results.items():
+            # A module whose imports were lost with a dead process would
+            # be stored with too few paths, and replayed after changes.
+            if name not in observed_names:
+                continue
+            if all(result == '.' for result in results):
+                paths = dependencies.paths_imported_by(name)
+                if dependencies.files.get(name) in paths:
+                    result_cache.store(name, paths, results)
+        result_cache.save()
+
     reporter.summarize()
+    reporter.report_fixtures(*fixture_counts)
+    reporter.report_forks(*fork_totals)
+    reporter.report_memory([memory_usages[worker] for worker in workers
+                            if memory_usages.get(worker) is not None],
+                           [peak_rss[worker] for worker in workers
+                            if worker in peak_rss])
+    history.save()
+    learned.save()
@@ -0,0 +1,197 @@
+"""Import modules once in each worker, before it forks to run tests."""
+
+from . import cache
+from .importation import STARTED_A_THREAD, improve_order, preload_modules
+
+class Levels(object):
+    """A stack of pre-warmed fork points in each worker.
+
+    Each level is a list of module names, imported in a child that the
+    worker pushes atop the previous level; the usual arrangement is a
+    level for the Standard Library, then one for third-party packages,
+    then one for the project itself.  Tests run in children forked from
+    the deepest level.  When a file changes, only the levels that
+    imported it, and the levels above them, are popped and rebuilt.
+
+    If a `learned` order is provided, then its modules are imported as
+    one final level, whose import events it then learns from.
+
+    """
+    def __init__(self, workers, module_lists, write, learned=None):
+        self.workers = workers
+        self.module_lists = module_lists
+        self.write = write
+        self.learned = learned
+        self.paths = []         # the paths imported by each pushed level
+
+    def push(self):
+        """Push every level that is not already in place."""
+        module_lists = list(self.module_lists)
+        if self.learned is not None:
+            module_names = self.learned.module_names()
+            if module_names:
+                module_lists.append(module_names)
+        workers = self.workers
+        for i in range(len(self.paths), len(module_lists)):
+            module_names = module_lists[i]
+            all_failures = []
+            while True:
+                for worker in workers:
+                    worker.push()
+                for worker in workers:
+                    worker.send(preload_modules, module_names)
+                for worker in workers:
+                    paths, import_events, failures = worker.reply()
+                all_failures.extend(failures)
+                # A thread would not survive the fork into each test, so
+                # the level is rebuilt without the module that started it.
+                threaded = set(module_name for module_name, message
+                               in failures if message == STARTED_A_THREAD)
+                if not threaded:
+                    break
+                for worker in workers:
+                    worker.pop()
+                module_names = [name for name in module_names
+                                if name not in threaded]
+            failures = all_failures
+            if i < len(self.module_lists):
+                for module_name, message in failures:
+                    self.write('Cannot preload {0}: {1}\n'
+                               .format(module_name, message))
+            else:
+                self.learned.learn(import_events, failures)
+            self.paths.append(set(paths))
+
+    def invalidate(self, changed_paths):
+        """Pop any levels that imported one of `changed_paths`.
+
+        Returns true if any levels were popped; `push()` can then be
+        called to rebuild them.
+
+        """
+        changed_paths = set(changed_paths)
+        for i, paths in enumerate(self.paths):
+            if paths & changed_paths:
+                break
+        else:
+            return False
+        for paths in self.paths[i:]:
+            for worker in self.workers:
+                worker.pop()
+        del self.paths[i:]
+        return True
+
+    def all_paths(self):
+        """Return the paths of every module imported by the levels."""
+        return set().union(*self.paths)
+
+class LearnedOrder(object):
+    """The modules that tests import, in an order learned run by run.
+
+    After each run, `observe()` appends any newly seen modules that the
+    tests imported.  Next time, the modules are preloaded in that order,
+    and `learn()` uses ``improve_order()`` to move each module that
+    pulled in others as a side effect to after those others.
+
+    A module is considered dangerous, and left out from then on, if it
+    fails to import, if it starts a thread, or if its import keeps
+    pulling in other modules however many times the order is improved.
+
+    """
+    filename = 'imports.pickle'
+    max_moves = 3
+
+    def __init__(self, order=None, dangers=None, moves=None):
+        self.order = [] if order is None else order
+        self.dangers = set() if dangers is None else dangers
+        self.moves = {} if moves is None else moves
+
+    @classmethod
+    def load(cls):
+        return cls(*cache.load(cls.filename, ()))
+
+    def save(self):
+        cache.save(self.filename, (self.order, self.dangers, self.moves))
+
+    def module_names(self):
+        """Return the modules that should be preloaded, in order."""
+        dangers = self.dangers
+        return [name for name in self.order if name not in dangers]
+
+    def learn(self, import_events, failures):
+        """Learn from the `import_events` of preloading our modules."""
+        # A package and the modules inside of it import each other as a
+        # matter of course, so only imports of unrelated modules count.
+        import_events = [(module_name, set(name for name in names_imported
+                                           if not related(module_name, name)))
+                         for module_name, names_imported in import_events]
+        moves = self.moves
+        for module_name, names_imported in import_events:
+            if names_imported:
+                moves[module_name] = moves.get(module_name, 0) + 1
+                if moves[module_name] >= self.max_moves:
+                    self.dangers.add(module_name)
+        for module_name, message in failures:
+            self.dangers.add(module_name)
+        order = improve_order(import_events)
+        known = set(order)
+        order.extend(name for name in self.order if name not in known)
+        self.order = parents_first(order)
+
+    def observe(self, module_paths, excluded_names):
+        """Append modules, that tests imported, to the end of our order.
+
+        The `module_paths` are tuples as returned by `list_module_paths()`
+        in the order the modules were imported.  Modules named in
+        `excluded_names`, like the test modules themselves, are skipped.
+
+        """
+        known = set(self.order)
+        for name, path in module_paths:
+            if name in known or name in excluded_names:
+                continue
+            if name.startswith('__main__'):
+                continue
+            known.add(name)
+            self.order.append(name)
+
+def related(name1, name2):
+    """Return whether two module names are the same, or parent and child.
+
+    >>> related('a.b', 'a'), related('a.b', 'a.b.c'), related('a.b', 'a.c')
+    (True, True, False)
+
+    """
+    return (name1 == name2 or name1.startswith(name2 + '.')
+            or name2.startswith(name1 + '.'))
+
+def parents_first(module_names):
+    """Move each module, if necessary, to after its enclosing package.
+
+    Importing a module always imports its package first, so a module
+    listed before its package is moved to just after the package.
+
+    >>> parents_first(['a.b.c', 'x', 'a', 'a.d'])
+    ['x', 'a', 'a.b.c', 'a.d']
+
+    """
+    names = set(module_names)
+    placed = set()
+    order = []
+    waiting = {}
+
+    def place(name):
+        placed.add(name)
+        order.append(name)
+        for child in waiting.pop(name, ()):
+            place(child)
+
+    for name in module_names:
+        parent = name.rpartition('.')[0]
+        while parent and parent not in names:
+            parent = parent.rpartition('.')[0]
+        if parent and parent not in placed:
+            waiting.setdefault(parent, []).append(name)
+        else:
+            place(name)
+    return order
@@ -0,0 +1,127 @@
+"""Replay the results of test modules whose code has not changed."""
+
+import hashlib
+import os
+import sys
+from . import cache
+
+class ResultCache(object):
+    """Results of passing test modules, filed under a hash of their code.
+
+    The manifest remembers which paths each test module imported when
+    it last passed.  A module's key is a hash over the contents of all
+    of those paths, so any change to the module or to anything it
+    imports produces a new key, and the old entry is simply never seen
+    again.  Entries are written atomically and never modified, so
+    several runs of the same checkout can safely share the cache; the
+    least recently used entries are evicted once the entries together
+    exceed `max_bytes`.
+
+    The `variant` names anything else that decides which tests run,
+    like the --cases strategy, so that results are only replayed by a
+    run that would have run the same cases.
+
+    """
+    manifest_filename = 'results.pickle'
+    directory_name = 'results'
+    max_bytes = 16 * 1024 * 1024
+    version = 1
+
+    def __init__(self, manifest=None, variant=''):
+        self.manifest = {} if manifest is None else manifest
+        self.variant = variant
+        self.stored = {}        # manifest entries added by this run
+        self.digests = {}       # path -> hash of its contents
+
+    @classmethod
+    def load(cls, variant=''):
+        return cls(cache.load(cls.manifest_filename, None), variant)
+
+    def save(self):
+        """Merge our new entries into the manifest, then evict old results."""
+        if not self.stored:
+            return
+        manifest = cache.load(self.manifest_filename, {})
+        manifest.update(self.stored)
+        cache.save(self.manifest_filename, manifest)
+        self.evict()
+
+    def lookup(self, module_name):
+        """Return a module's cached results, or None if it needs to run."""
+        paths = self.manifest.get(module_name)
+        if paths is None:
+            return None
+        key = self.key(module_name, paths)
+        if key is None:
+            return None
+        results = cache.load(os.path.join(self.directory_name, key), None)
+        if results is not None:
+            try:
+                os.utime(os.path.join(self.directory(), key), None)
+            except OSError:
+                pass
+        return results
+
+    def store(self, module_name, paths, results):
+        """Remember the `results` of a module that imported `paths`."""
+        paths = sorted(paths)
+        key = self.key(module_name, paths)
+        if key is None:
+            return
+        cache.save(os.path.join(self.directory_name, key), results)
+        self.manifest[module_name] = paths
+        self.stored[module_name] = paths
+
+    def key(self, module_name, paths):
+        """Hash a module name with the contents of `paths`; None if missing."""
+        h = hashlib.sha1()
+        h.update('{0}\0{1}\0{2}\0{3}\0'.format(
+            self.version, sys.version, self.variant,
+            module_name).encode('utf-8'))
+        for path in paths:
+            digest = self.digest(path)
+            if digest is None:
+                return None
+            h.update(path.encode('utf-8', 'replace') + b'\0' + digest)
+        return h.hexdigest()
+
+    def digest(self, path):
+        """Return a hash of the contents of `path`, or None if unreadable."""
+        digest = self.digests.get(path)
+        if digest is None:
+            try:
+                with open(path, 'rb') as f:
+                    digest = hashlib.sha1(f.read()).digest()
+            except (IOError, OSError):
+                return None
+            self.digests[path] = digest
+        return digest
+
+    def directory(self):
+        return os.path.join(cache.cache_directory(), self.directory_name)
+
+    def evict(self):
+        """Delete the least recently used entries until under `max_bytes`."""
+        directory = self.directory()
+        entries = []
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue    # another run evicted it first
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for mtime, size, path in entries)
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
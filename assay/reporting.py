@@ -15,17 +15,61 @@ help_message = """
  [j] Next error         [J] Last error
  [k] Previous error     [K] First error
  [l] List failing tests
+ [a] Run all tests
  [r] Restart Assay
  [q] Quit Assay
  [?] Help (this summary)
 """  # Future: [m] Pipe all errors to more(1) or else your custom $PAGER
 
-class BatchReporter(object):
-    def __init__(self, write_callback):
+class Reporter(object):
+    """Behaviors shared by our reporters."""
+
+    first_result_time = None
+
+    def report_results(self, results):
+        """Report a list of results, writing their output all at once."""
+        if results and self.first_result_time is None:
+            self.first_result_time = time()
+        pieces = []
+        write_callback = self.write_callback
+        self.write_callback = pieces.append
+        try:
+            for result in results:
+                self.report_result(result)
+        finally:
+            self.write_callback = write_callback
+        if pieces:
+            write_callback(''.join(pieces))
+
+    def timing(self):
+        """Describe how long the run took, and how soon results arrived."""
+        dt = time() - self.t0
+        text = '{0:.2f} seconds'.format(dt)
+        if self.first_result_time is not None:
+            text += ' (first result after {0:.2f})'.format(
+                self.first_result_time - self.t0)
+        return text
+
+    def report_memory(self, usages, peaks=()):
+        """Report the ``(shared, private)`` memory of each worker.
+
+        The `peaks` are the greatest resident size, in bytes, that any
+        of each worker's test processes reached.
+
+        """
+
+    def report_fixtures(self, hits, misses):
+        """Report how often scoped fixtures were found in their cache."""
+
+    def report_forks(self, forks, seconds):
+        """Report how many processes isolated tests, and their overhead."""
+
+class BatchReporter(Reporter):
+    def __init__(self, write_callback, t0=None):
         self.write_callback = write_callback
         self.errors = 0
         self.tests = 0
-        self.t0 = time()
+        self.t0 = time() if t0 is None else t0
 
     def report_result(self, result):
         self.tests += 1
@@ -36,23 +80,43 @@ class BatchReporter(object):
             self.write_callback(pretty_format_error(*result))
 
     def summarize(self):
-        dt = time() - self.t0
         if self.errors:
             tally = '{0} of {1} tests failed'.format(self.errors, self.tests)
         else:
             tally = 'All {0} tests passed'.format(self.tests)
-        self.write_callback('\n\n{0} in {1:.2f} seconds\n'.format(tally, dt))
-
-
-class InteractiveReporter(object):
-    def __init__(self, write_callback):
+        self.write_callback('\n\n{0} in {1}\n'.format(tally, self.timing()))
+
+    def report_memory(self, usages, peaks=()):
+        if usages:
+            self.write_callback('Worker memory, MB shared + private: {0}\n'
+                                .format(' '.join('{0:.1f}+{1:.1f}'.format(
+                                    shared / 1e6, private / 1e6)
+                                    for shared, private in usages)))
+        if peaks:
+            self.write_callback('Worker peak RSS, MB: {0}\n'.format(
+                ' '.join('{0:.1f}'.format(peak / 1e6) for peak in peaks)))
+
+    def report_fixtures(self, hits, misses):
+        if hits or misses:
+            self.write_callback('Scoped fixtures: {0} cache hits, {1} misses\n'
+                                .format(hits, misses))
+
+    def report_forks(self, forks, seconds):
+        if forks:
+            self.write_callback('Isolated tests: {0} forks, {1:.2f} ms'
+                                ' overhead each\n'.format(
+                                    forks, seconds * 1000.0 / forks))
+
+
+class InteractiveReporter(Reporter):
+    def __init__(self, write_callback, t0=None):
         self.write_callback = write_callback
         self.letters = []
         self.errors = []
         self.index = 0
         self.column = 0
         self.period = 78 - help_hint_length
-        self.t0 = time()
+        self.t0 = time() if t0 is None else t0
 
     def write(self, s):
         """Write out the string `s`, keeping track of the cursor column."""
@@ -88,14 +152,13 @@ class InteractiveReporter(object):
         self.write('\r' + black(message))
 
     def summarize(self):
-        dt = time() - self.t0
         failures = len(self.errors)
         total = len(self.letters)
         if failures:
             tally = red('\r{0} of {1} tests failed'.format(failures, total))
         else:
             tally = green('\nAll {0} tests passed'.format(total))
-        self.write('{0} in {1:.2f} seconds '.format(tally, dt))
+        self.write('{0} in {1} '.format(tally, self.timing()))
 
     def process_keystroke(self, keystroke):
         if keystroke == b'?':
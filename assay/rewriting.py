@@ -0,0 +1,96 @@
+"""An import hook that rewrites assert statements as modules are imported.
+
+Rewriting a module's asserts before its code ever runs means that the
+very first failure of a bare ``assert`` can explain itself, instead of
+the test having to be run a second time after its failure.  Modules of
+the Standard Library and of installed packages are left alone.
+
+"""
+import hashlib
+import marshal
+import os
+import sys
+import sysconfig
+from . import assertion, cache
+from .assertion import (assert_pattern_text, code_for_marshal,
+                        code_from_marshal, rewrite_asserts_in_code)
+
+# Rewritten code is cached in a directory whose name changes with the
+# Python version, and with the patterns and stanza templates that find
+# the asserts, so that code cached by a different Python or a different
+# Assay is never used.
+
+REWRITE_VERSION = 1
+code_directory_name = os.path.join('code', hashlib.sha1(b'\0'.join([
+    str(REWRITE_VERSION).encode('ascii'),
+    sys.version.encode('utf-8'),
+    assert_pattern_text,
+    repr(getattr(assertion, 'stanza_templates', None)).encode('ascii'),
+])).hexdigest()[:16])
+
+try:
+    from importlib.abc import MetaPathFinder
+    from importlib.machinery import PathFinder, SourceFileLoader
+except ImportError:
+    MetaPathFinder = None  # Python 2: no hook, so asserts get re-run
+
+def install_import_hook():
+    """Start rewriting the asserts of modules imported from now on."""
+    if MetaPathFinder is not None and _finder not in sys.meta_path:
+        sys.meta_path.insert(0, _finder)
+
+def cache_key(path):
+    """Return the name under which to cache the code of the file `path`."""
+    return hashlib.sha1(path.encode('utf-8', 'surrogateescape')).hexdigest()
+
+def library_directories():
+    """Return the directories where Python and its packages live."""
+    paths = sysconfig.get_paths()
+    names = ('stdlib', 'platstdlib', 'purelib', 'platlib')
+    return tuple(os.path.join(os.path.realpath(paths[name]), '')
+                 for name in names if name in paths)
+
+if MetaPathFinder is not None:
+
+    class AssertRewritingLoader(SourceFileLoader):
+        """Load a module from source, rewriting its asserts."""
+
+        def get_code(self, fullname):
+            # A normal .pyc would lack our rewrites, so instead of using
+            # one we keep our own cache of rewritten code objects.
+            path = self.get_filename(fullname)
+            source = self.get_data(path)
+            source_hash = hashlib.sha1(source).digest()
+            name = os.path.join(code_directory_name, cache_key(path))
+            entry = cache.load(name, None)
+            if entry is not None and entry[0] == source_hash:
+                try:
+                    return code_from_marshal(marshal.loads(entry[1]))
+                except (EOFError, ValueError, TypeError):
+                    pass
+            code = self.source_to_code(source, path)
+            data = marshal.dumps(code_for_marshal(code))
+            cache.save(name, (source_hash, data))
+            return code
+
+        def source_to_code(self, data, path, _optimize=-1):
+            code = compile(data, path, 'exec', dont_inherit=True,
+                           optimize=_optimize)
+            return rewrite_asserts_in_code(code)
+
+    class AssertRewritingFinder(MetaPathFinder):
+        """Find modules as usual, but load those of the project ourselves."""
+
+        def __init__(self):
+            self.library_directories = library_directories()
+
+        def find_spec(self, fullname, path, target=None):
+            spec = PathFinder.find_spec(fullname, path, target)
+            if (spec is None or type(spec.loader) is not SourceFileLoader
+                or os.path.realpath(spec.origin).startswith(
+                    self.library_directories)):
+                return spec
+            spec.loader = AssertRewritingLoader(fullname, spec.origin)
+            return spec
+
+    _finder = AssertRewritingFinder()
@@ -7,73 +7,414 @@ import inspect
 import linecache
 import os
 import sys
-from types import FunctionType
+import tempfile
+from collections import OrderedDict
+from itertools import chain, islice, product
+from time import time
+from types import FunctionType, GeneratorType
 from .assertion import get_code, search_for_function, rewrite_asserts_in
-from .importation import import_module
+from . import cache
+from .compatibility import unittest
+from .importation import import_module, take_new_imports
+from .unix import available_memory, describe_exit, die_with_parent
+
+if sys.version_info >= (3,):
+    import pickle
+else:
+    import cPickle as pickle
 
 class Failure(Exception):
     """Test failure encountered during importation or setup."""
 
-_python3 = sys.version_info >= (3,)
+class Timing(object):
+    """Report, in place of a result, how many seconds a test took.
+
+    If the test ran in child processes of its own, `forks` says how
+    many, and `fork_seconds` how much of its time went to forking them.
+    The `fixture_seconds` dictionary gives the setup time of each scoped
+    fixture that the test built, as explained by `FixtureCache`.
+
+    """
+    def __init__(self, test_name, seconds, forks=0, fork_seconds=0.0,
+                 fixture_seconds=None):
+        self.test_name = test_name
+        self.seconds = seconds
+        self.forks = forks
+        self.fork_seconds = fork_seconds
+        self.fixture_seconds = fixture_seconds or {}
+
+class Fixtures(object):
+    """Report, in place of a result, which scoped fixtures tests use.
+
+    The `uses` dictionary maps each test name to the keys of the scoped
+    fixtures it needs, and `setup_seconds` gives the setup time of those
+    built while the tests were being listed.
+
+    """
+    def __init__(self, uses, setup_seconds):
+        self.uses = uses
+        self.setup_seconds = setup_seconds
+
+class Imports(object):
+    """Report, in place of a result, what a job newly imported.
+
+    The `module_paths` and `graph` are as returned by
+    ``take_new_imports()``, and arrive only from a job that finished.
+
+    """
+    def __init__(self, module_paths, graph):
+        self.module_paths = module_paths
+        self.graph = graph
+
+class Teardown(object):
+    """Report, in place of a result, a failed teardown of module fixtures.
+
+    The `failure` belongs to `module_name`, whose tests used the fixture,
+    rather than to whichever job happened to end the fixture's scope.
+
+    """
+    def __init__(self, module_name, failure):
+        self.module_name = module_name
+        self.failure = failure
+
 _no_such_fixture = object()
+_fixture_graphs = {}  # module name -> FixtureGraph
 _is_noisy_filename = (__file__, assay.__file__).__contains__
+_is_comparison_filename = frozenset([
+    get_code(search_for_function).co_filename,
+    get_code(unittest.TestCase.assertEqual).co_filename,
+]).__contains__
 
-if _python3:
-    from io import StringIO
-else:
-    from StringIO import StringIO
-
-def capture_stdout_stderr(generator, *args):
-    """Call a generator, supplementing its tuples with stdout, stderr data."""
-    oldout = sys.stdout
-    olderr = sys.stderr
-    out = StringIO()
-    err = StringIO()
-    sys.stdout = out
-    sys.stderr = err
+OUTPUT_HEAD = 8192      # bytes of a test's output to keep from the start
+OUTPUT_TAIL = 8192      # and from the end, when it has too much to send
+OUTPUT_LOGS = 20        # files of full output to keep in the cache
+LOW_MEMORY = 256 * 1024 * 1024  # evict cached fixtures below this much
+
+_fork_totals = [0, 0.0]  # forks by run_test_in_child(), and their overhead
+
+def capture_stdout_stderr(generator, *args, **kw):
+    """Call a generator, supplementing its tuples with stdout, stderr data.
+
+    Output is captured at the level of file descriptors 1 and 2, so it
+    includes what C extensions and subprocesses print, and it goes into
+    scratch files instead of filling up memory.  Each tuple gets only
+    the head and tail of very long output, together with the name of a
+    file where the full output has been saved.
+
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    out = Capture(1)
+    err = Capture(2)
     try:
-        for item in generator(*args):
+        for item in generator(*args, **kw):
+            sys.stdout.flush()
+            sys.stderr.flush()
             if isinstance(item, tuple):
-                yield item + (out.getvalue(), err.getvalue())
+                yield item + (out.read(), err.read())
             else:
+                out.clear()
+                err.clear()
                 yield item
-            out.truncate(0)
-            err.truncate(0)
     finally:
-        sys.stdout = oldout
-        sys.stderr = olderr
+        sys.stdout.flush()
+        sys.stderr.flush()
+        out.close()
+        err.close()
+
+class Capture(object):
+    """Redirect a file descriptor into an anonymous scratch file."""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.saved_fd = os.dup(fd)
+        self.scratch_fd, path = tempfile.mkstemp(prefix='assay-capture-')
+        os.unlink(path)
+        os.dup2(self.scratch_fd, fd)
+
+    def read(self):
+        """Return the output captured so far, then start afresh."""
+        size = self.tell()
+        if not size:
+            return ''
+        if size <= OUTPUT_HEAD + OUTPUT_TAIL:
+            data = self.read_at(0, size)
+        else:
+            data = b''.join([
+                self.read_at(0, OUTPUT_HEAD),
+                '\n[... {0} bytes omitted; full output in {1} ...]\n'.format(
+                    size - OUTPUT_HEAD - OUTPUT_TAIL, self.save(size),
+                ).encode('utf-8'),
+                self.read_at(size - OUTPUT_TAIL, OUTPUT_TAIL),
+            ])
+        self.clear()
+        return data.decode('utf-8', 'replace')
+
+    def read_at(self, offset, size):
+        fd = self.scratch_fd
+        os.lseek(fd, offset, os.SEEK_SET)
+        pieces = []
+        while size:
+            piece = os.read(fd, min(size, 65536))
+            if not piece:
+                break
+            pieces.append(piece)
+            size -= len(piece)
+        return b''.join(pieces)
+
+    def save(self, size):
+        """Copy the output to a log file, and return the file's path.
+
+        The log goes in the cache directory, which keeps only the most
+        recent `OUTPUT_LOGS` logs, so that runs in watch mode do not
+        pile them up without end.
+
+        """
+        directory = os.path.join(cache.cache_directory(), 'output')
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass  # it probably exists already
+        prune_logs(directory, OUTPUT_LOGS - 1)
+        fd, path = tempfile.mkstemp(prefix='assay-output-', suffix='.log',
+                                    dir=directory)
+        try:
+            offset = 0
+            while offset < size:
+                piece = self.read_at(offset, min(size - offset, 65536))
+                if not piece:
+                    break
+                os.write(fd, piece)
+                offset += len(piece)
+        finally:
+            os.close(fd)
+        return path
 
-def run_tests_of(module_name):
-    """Run all tests discovered inside of a module."""
+    def tell(self):
+        """Return how much has been written, via the shared file offset."""
+        return os.lseek(self.scratch_fd, 0, os.SEEK_CUR)
+
+    def clear(self):
+        """Discard the output captured so far."""
+        if self.tell():
+            os.ftruncate(self.scratch_fd, 0)
+            os.lseek(self.scratch_fd, 0, os.SEEK_SET)
+
+    def close(self):
+        """Restore the original file descriptor."""
+        os.dup2(self.saved_fd, self.fd)
+        os.close(self.saved_fd)
+        os.close(self.scratch_fd)
+
+def prune_logs(directory, count):
+    """Delete all but the `count` most recently written files."""
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            entries.append((os.stat(path).st_mtime, path))
+        except OSError:
+            continue    # another worker pruned it first
+    entries.sort()
+    for mtime, path in entries[:max(0, len(entries) - count)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def report_imports(generator, *args, **kw):
+    """Call a generator, then yield an `Imports` report of what it imported."""
+    for item in generator(*args, **kw):
+        yield item
+    yield Imports(*take_new_imports())
+
+def list_tests_of(module_name, count_cases=(), strategy=None,
+                  find_fixtures=False):
+    """Import a module, then yield a list of the names of its tests.
+
+    If `count_cases` names some of the tests, the list is preceded by a
+    dictionary that gives the number of cases of each of them that has
+    several combinations of fixture values, as returned by
+    `count_cases_of()`.  Since counting calls a test's fixtures, only
+    the tests named are counted.  If `find_fixtures` is true, the list
+    is also preceded by a `Fixtures` report, if any of the tests use
+    scoped fixtures.
+
+    """
     try:
         module = import_module(module_name)
     except Exception as e:
-        frames = [frame for frame in traceback_frames()
-                  if ('/importlib/' not in frame[0])
-                  and (' importlib.' not in frame[0])]
-        yield 'F', e.__class__.__name__, str(e), frames
+        yield import_failure(e)
         return
+    tests = find_tests(module)
+    if count_cases:
+        counted = [(name, test) for name, test in tests
+                   if name in count_cases]
+        counts = count_cases_of(module, counted, strategy)
+        if counts:
+            yield counts
+    if find_fixtures:
+        uses = scoped_fixtures_of(module, tests)
+        if uses:
+            yield Fixtures(uses, fixture_cache.take_setup_seconds())
+    yield [name for name, test in tests]
+
+def count_cases_of(module, tests, strategy=None):
+    """Return a dictionary of how many cases each parametrized test has.
 
-    tests = sorted((k, v) for k, v in module.__dict__.items()
-                   if k.startswith('test_') and isinstance(v, FunctionType)
-                   and getattr(v, '__module__', '') == module_name)
+    Each of a test's fixtures is iterated over to count its values.  A
+    test whose fixtures cannot be counted is left out, as it will report
+    the problem when it is run.
 
+    """
+    counts = {}
     for name, test in tests:
-        for result in run_test(module, test):
+        code = get_code(test)
+        if not code.co_argcount:
+            continue
+        count = 1
+        try:
+            names = inspect.getargs(code).args
+            fixtures, upstreams = fixture_graph(module).resolve(names)
+            if strategy is None:
+                for arg, fixture, upstream in zip(names, fixtures, upstreams):
+                    values = iterate_over_fixture(arg, fixture,
+                                                  module.__name__, upstream)
+                    count *= sum(1 for value in values)
+            else:
+                count = len(choose_arguments(names, fixtures,
+                                             module.__name__, strategy,
+                                             upstreams))
+        except Exception:
+            continue
+        if count > 1:
+            counts[name] = count
+    return counts
+
+def scoped_fixtures_of(module, tests):
+    """Return a dictionary of the scoped fixtures that each test needs.
+
+    The keys of every scoped fixture that a test takes, directly or
+    through other fixtures, are listed as `fixture_key()` gives them.
+
+    """
+    graph = fixture_graph(module)
+    uses = {}
+    for name, test in tests:
+        code = get_code(test)
+        if not code.co_argcount:
+            continue
+        try:
+            keys = graph.scoped_keys(inspect.getargs(code).args)
+        except Exception:
+            continue
+        if keys:
+            uses[name] = keys
+    return uses
+
+def split_test_item(item):
+    """Return the name of the test that `item` names, and its cases.
+
+    The test names given to `run_tests_of()` can include tuples of the
+    form ``(name, start, stop)``, which ask for only the cases numbered
+    from `start` up to, but not including, `stop`.  The cases are None
+    if the item is simply a name.
+
+    """
+    if isinstance(item, tuple):
+        return item[0], item[1:]
+    return item, None
+
+def describe_test_item(item):
+    """Return the name of a test item, with its range of cases if any."""
+    name, cases = split_test_item(item)
+    if cases is None:
+        return name
+    return '{0} (cases {1}-{2})'.format(name, cases[0], cases[1] - 1)
+
+def run_tests_of(module_name, test_names=None, timed=False,
+                 isolated=False, strategy=None):
+    """Run the tests inside of a module; all of them, unless given names.
+
+    If `timed` is true, then a `Timing` follows the results of each test.
+    If `isolated` is true, then each test runs in a child process of its
+    own, as explained by `run_test_in_child()`.  A `strategy` from the
+    `combinations` module chooses which combinations of fixture values
+    each parametrized test runs with, instead of all of them.
+
+    """
+    try:
+        module = import_module(module_name)
+    except Exception as e:
+        yield import_failure(e)
+        return
+
+    if test_names is None:
+        tests = [(name, test, None) for name, test in find_tests(module)]
+    else:
+        tests = []
+        for item in test_names:
+            name, cases = split_test_item(item)
+            tests.append((name, getattr(module, name), cases))
+
+    for result in fixture_cache.end_modules_other_than(module_name):
+        yield result
+
+    for name, test, cases in tests:
+        t0 = time()
+        forks, fork_seconds = _fork_totals
+        for result in run_test(module, test, isolated, cases, strategy):
             yield result
+        if fixture_cache.grew:
+            for result in fixture_cache.evict_if_memory_is_low():
+                yield result
+        if timed:
+            yield Timing(name, time() - t0, _fork_totals[0] - forks,
+                         _fork_totals[1] - fork_seconds,
+                         fixture_cache.take_setup_seconds())
+
+def find_tests(module):
+    """Return a sorted list of ``(name, function)`` tests in `module`."""
+    module_name = module.__name__
+    return sorted((k, v) for k, v in module.__dict__.items()
+                  if k.startswith('test_') and isinstance(v, FunctionType)
+                  and getattr(v, '__module__', '') == module_name)
+
+def import_failure(e):
+    """Build a failure for an exception raised while importing a module."""
+    frames = [frame for frame in traceback_frames()
+              if ('/importlib/' not in frame[0])
+              and (' importlib.' not in frame[0])]
+    return 'F', e.__class__.__name__, str(e), frames
 
-def run_test(module, test):
-    """Run a test, detecting whether it needs fixtures and providing them."""
+def run_test(module, test, isolated=False, cases=None, strategy=None):
+    """Run a test, detecting whether it needs fixtures and providing them.
+
+    If `cases` is a tuple ``(start, stop)``, only that slice of the
+    combinations of fixture values is run.  The failure of a case that
+    a `strategy` chose says how to choose the same cases again.
+
+    """
+    run = run_test_in_child if isolated else run_test_with_arguments
     code = get_code(test)
     if not code.co_argcount:
-        yield run_test_with_arguments(test, ())
+        yield run(test, ())
         return
 
     try:
         names = inspect.getargs(code).args
-        fixtures = [find_fixture(module, name) for name in names]
-        for args in generate_arguments_from_fixtures(names, fixtures):
-            yield run_test_with_arguments(test, args)
+        fixtures, upstreams = fixture_graph(module).resolve(names)
+        arguments = choose_arguments(names, fixtures, module.__name__,
+                                     strategy, upstreams)
+        if cases is not None:
+            arguments = islice(arguments, *cases)
+        for args in arguments:
+            result = run(test, args)
+            if strategy is not None and result != '.':
+                message = '{0} [case chosen by {1}]'.format(
+                    result[2], strategy.description())
+                result = result[:2] + (message,) + result[3:]
+            yield result
     except Exception as e:
         frames = traceback_frames()
         filename = relativize(code.co_filename)
@@ -93,15 +434,131 @@ def find_fixture(module, name):
         raise Failure('no such fixture {0!r}'.format(name))
     return fixture
 
-def generate_arguments_from_fixtures(names, fixtures):
+SCOPE_WIDTHS = {None: 0, 'module': 1, 'session': 2}
+
+def fixture_key(fixture, module_name):
+    """Name the cache entry of a scoped fixture, in a way that lasts.
+
+    The key is a tuple ``(module_name, name)``, with None in place of
+    the module name for a session-scoped fixture, since its values are
+    shared by every module.  Unlike the fixture itself, a key can be
+    saved and compared with those of later runs.
+
+    """
+    scope_name = module_name if fixture.assay_scope == 'module' else None
+    return scope_name, '{0}.{1}'.format(fixture.__module__, fixture.__name__)
+
+def fixture_graph(module):
+    """Return the `FixtureGraph` of a test module, building it only once."""
+    graph = _fixture_graphs.get(module.__name__)
+    if graph is None or graph.module is not module:
+        graph = _fixture_graphs[module.__name__] = FixtureGraph(module)
+    return graph
+
+class FixtureGraph(object):
+    """The fixtures of a test module, and which fixtures each one takes.
+
+    A fixture function can take other fixtures by naming them as its
+    parameters, just as a test does, and is then called once for every
+    combination of their values.  Each fixture is looked up the first
+    time that a test needs it, and its place in the graph is remembered
+    for the module's later tests.  A cycle is reported as a failure, as
+    is a scoped fixture that takes a fixture of narrower scope, whose
+    values might change while the scoped fixture's are still cached.
+
+    """
+    def __init__(self, module):
+        self.module = module
+        self.nodes = {}  # name -> (fixture, names of the fixtures it takes)
+
+    def node(self, name, path=()):
+        """Return a fixture and the names it takes, checking its ancestry."""
+        node = self.nodes.get(name)
+        if node is not None:
+            return node
+        if name in path:
+            cycle = path[path.index(name):] + (name,)
+            raise Failure('fixtures form a cycle: {0}'.format(
+                ' -> '.join(cycle)))
+        fixture = find_fixture(self.module, name)
+        dependencies = ()
+        if isinstance(fixture, FunctionType):
+            code = get_code(fixture)
+            args = inspect.getargs(code).args[:code.co_argcount]
+            dependencies = tuple(args[:len(args) - len(
+                fixture.__defaults__ or ())])
+        scope = getattr(fixture, 'assay_scope', None)
+        for dependency in dependencies:
+            upstream = self.node(dependency, path + (name,))[0]
+            upstream_scope = getattr(upstream, 'assay_scope', None)
+            if SCOPE_WIDTHS[upstream_scope] < SCOPE_WIDTHS[scope]:
+                raise Failure('{0}-scoped fixture {1!r} cannot take the'
+                              ' narrower fixture {2!r}'.format(
+                                  scope, name, dependency))
+        node = self.nodes[name] = fixture, dependencies
+        return node
+
+    def resolve(self, names):
+        """Return the fixtures named, and the values of those they take.
+
+        The second list gives, for each fixture in `names`, the list of
+        values of every fixture it takes.  A fixture that several others
+        take is built only once, and its values shared between them; if
+        a test also names it directly, the test gets the same values.
+
+        """
+        built = {}
+        upstreams = []
+        for name in names:
+            fixture, dependencies = self.node(name)
+            upstreams.append([self.values(dependency, built)
+                              for dependency in dependencies])
+        fixtures = [built.get(name, self.nodes[name][0]) for name in names]
+        return fixtures, upstreams
+
+    def scoped_keys(self, names):
+        """Return the sorted keys of the scoped fixtures `names` need."""
+        keys = set()
+        stack = list(names)
+        seen = set()
+        while stack:
+            name = stack.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            fixture, dependencies = self.node(name)
+            if hasattr(fixture, 'assay_scope'):
+                keys.add(fixture_key(fixture, self.module.__name__))
+            stack.extend(dependencies)
+        return sorted(keys, key=repr)
+
+    def values(self, name, built):
+        """Return the values of a fixture, building it if not yet `built`."""
+        values = built.get(name)
+        if values is None:
+            fixture, dependencies = self.node(name)
+            upstream = [self.values(dependency, built)
+                        for dependency in dependencies]
+            values = built[name] = list(iterate_over_fixture(
+                name, fixture, self.module.__name__, upstream))
+        return values
+
+def generate_arguments_from_fixtures(names, fixtures, module_name=None,
+                                     upstreams=None):
     """Yield all combinations of the outputs of a list of fixtures.
 
+    Each item of `upstreams`, if given, lists the values of the fixtures
+    that the corresponding fixture takes.
+
     >>> list(generate_arguments_from_fixtures(['f1', 'f2'], ['AB', 'xy']))
     [('A', 'x'), ('A', 'y'), ('B', 'x'), ('B', 'y')]
 
     """
-    iterators = [iterate_over_fixture(name, fixture) for name, fixture
-                 in zip(names, fixtures)]
+    if upstreams is None:
+        upstreams = [()] * len(names)
+    iterators = [iterate_over_fixture(name, fixture, module_name, upstream)
+                 for name, fixture, upstream
+                 in zip(names, fixtures, upstreams)]
     args = [next(i) for i in iterators]
     backwards = list(reversed(range(len(iterators))))
     while True:
@@ -110,22 +567,240 @@ def generate_arguments_from_fixtures(names, fixtures):
             try:
                 args[j] = next(iterators[j])
             except StopIteration:
-                iterators[j] = iterate_over_fixture(names[j], fixtures[j])
+                iterators[j] = iterate_over_fixture(names[j], fixtures[j],
+                                                    module_name, upstreams[j])
                 args[j] = next(iterators[j])
             else:
                 break
         else:
             return
 
-def iterate_over_fixture(name, fixture):
-    """Try iterating over a fixture, whether it is a sequence or generator."""
+def choose_arguments(names, fixtures, module_name, strategy,
+                     upstreams=None):
+    """Return the combinations of fixture values that `strategy` picks.
+
+    A `strategy` of None means every combination, which are generated
+    lazily, instead of being computed all at once.
+
+    """
+    if strategy is None:
+        return generate_arguments_from_fixtures(names, fixtures, module_name,
+                                                upstreams)
+    if upstreams is None:
+        upstreams = [()] * len(names)
+    value_lists = [list(iterate_over_fixture(name, fixture, module_name,
+                                             upstream))
+                   for name, fixture, upstream
+                   in zip(names, fixtures, upstreams)]
+    sizes = [len(values) for values in value_lists]
+    return [tuple(values[i] for values, i in zip(value_lists, case))
+            for case in strategy.choose(sizes)]
+
+def iterate_over_fixture(name, fixture, module_name=None, upstream=()):
+    """Try iterating over a fixture, whether it is a sequence or generator.
+
+    If the fixture takes other fixtures, `upstream` lists their values,
+    and the fixture's values for each combination of them are chained.
+
+    """
+    if isinstance(fixture, FunctionType) and hasattr(fixture, 'assay_scope'):
+        return iter(fixture_cache.values(name, fixture, module_name,
+                                         upstream))
+    if upstream:
+        return chain.from_iterable(iterate_over_fixture(name, fixture(*args))
+                                   for args in product(*upstream))
     if callable(fixture):
-        fixture = fixture()  # TODO: make fixtures able to take other fixtures
+        fixture = fixture()
     try:
         return iter(fixture)
     except Exception:
         raise Failure('fixture {0!r} is not iterable'.format(name))
 
+class FixtureCache(object):
+    """The values of scoped fixtures, kept until their scopes end.
+
+    Entries are kept in order from least to most recently used, so that
+    if memory runs low, the entries evicted are those used least lately.
+    The seconds that each entry took to compute are kept, by the entry's
+    `fixture_key()`, until `take_setup_seconds()` is called.
+
+    """
+    def __init__(self):
+        self.entries = OrderedDict()  # key -> (name, values, generators)
+        self.hits = 0
+        self.misses = 0
+        self.grew = False
+        self.setup_seconds = {}
+
+    def values(self, name, fixture, module_name, upstream=()):
+        """Return a list of the values of a scoped fixture.
+
+        A fixture that takes others, whose values are listed in
+        `upstream`, is called once for each combination of them.
+
+        """
+        scope_name = module_name if fixture.assay_scope == 'module' else None
+        key = (fixture, scope_name)
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            t0 = time()
+            entry = self.compute(name, fixture, upstream)
+            self.setup_seconds[fixture_key(fixture, module_name)] = time() - t0
+            self.grew = True
+        else:
+            self.hits += 1
+        self.entries[key] = entry
+        return entry[1]
+
+    def compute(self, name, fixture, upstream=()):
+        values = []
+        generators = []
+        for args in product(*upstream):
+            result = fixture(*args)
+            if isinstance(result, GeneratorType):
+                generators.append(result)
+                for value in result:
+                    values.append(value)
+                    break
+                else:
+                    raise Failure('fixture {0!r} did not yield a value'
+                                  .format(name))
+                continue
+            try:
+                values.extend(result)
+            except TypeError:
+                raise Failure('fixture {0!r} is not iterable'.format(name))
+        return name, values, generators
+
+    def take_setup_seconds(self):
+        """Return, and forget, the setup times recorded since last time."""
+        setup_seconds = self.setup_seconds
+        self.setup_seconds = {}
+        return setup_seconds
+
+    def end_modules_other_than(self, module_name):
+        """Tear down module-scoped entries not of `module_name`."""
+        keys = [key for key in self.entries
+                if key[1] is not None and key[1] != module_name]
+        return self.remove(keys)
+
+    def evict_if_memory_is_low(self):
+        """Tear down entries, oldest first, until memory is no longer low."""
+        self.grew = False
+        failures = []
+        while self.entries:
+            memory = available_memory()
+            if memory is None or memory >= LOW_MEMORY:
+                break
+            failures.extend(self.remove([next(iter(self.entries))]))
+        return failures
+
+    def clear(self):
+        """Tear down every entry, and return ``(hits, misses, failures)``.
+
+        The counts are reset, ready for the process's next run.
+
+        """
+        failures = self.remove(list(self.entries))
+        counts = self.hits, self.misses
+        self.hits = self.misses = 0
+        self.setup_seconds = {}
+        return counts + (failures,)
+
+    def remove(self, keys):
+        """Remove entries, running the teardown of generator fixtures.
+
+        Returns a list of failures for any teardown that goes wrong,
+        each wrapped in a `Teardown` if the fixture was module-scoped.
+
+        """
+        failures = []
+        for key in keys:
+            scope_name = key[1]
+            name, values, generators = self.entries.pop(key)
+            for generator in generators:
+                try:
+                    for value in generator:
+                        generator.close()
+                        raise Failure('it yielded more than one value')
+                except Exception as e:
+                    message = 'teardown of fixture {0!r}: {1}'.format(name, e)
+                    frames = traceback_frames()
+                    failure = 'F', e.__class__.__name__, message, frames
+                    if scope_name is not None:
+                        failure = Teardown(scope_name, failure)
+                    failures.append(failure)
+        return failures
+
+fixture_cache = FixtureCache()
+
+def clear_fixture_cache():
+    """Tear down all cached fixtures, capturing what their teardown prints.
+
+    Returns a list of any failures, followed by ``[hits, misses]``.
+
+    """
+    return list(capture_stdout_stderr(_clear_fixture_cache))
+
+def _clear_fixture_cache():
+    hits, misses, failures = fixture_cache.clear()
+    for failure in failures:
+        yield failure
+    yield [hits, misses]
+
+def run_test_in_child(test, args):
+    """Return the result of invoking a test in a child process.
+
+    The fixtures have already been built in this process, so the child
+    starts with a copy-on-write snapshot of them; whatever the test
+    changes vanishes with the child, and the next test sees pristine
+    fixtures again at the cost of a fork instead of a fresh setup.
+
+    The child dies with this process, and while it runs, it answers
+    requests for this process's stack in its place.
+
+    """
+    from .timeouts import stack_dumps_from  # which imports this module
+
+    t0 = time()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    from_child, to_parent = os.pipe()
+    parent_pid = os.getpid()
+    pid = os.fork()
+    if not pid:
+        try:
+            die_with_parent(parent_pid)
+            os.close(from_child)
+            t1 = time()
+            result = run_test_with_arguments(test, args)
+            seconds = time() - t1
+            sys.stdout.flush()
+            sys.stderr.flush()
+            try:
+                data = pickle.dumps((result, seconds), 2)
+            except Exception as e:
+                result = 'E', type(e).__name__, str(e), []
+                data = pickle.dumps((result, seconds), 2)
+            while data:
+                data = data[os.write(to_parent, data):]
+        finally:
+            os._exit(0)
+    os.close(to_parent)
+    with stack_dumps_from(pid), os.fdopen(from_child, 'rb') as f:
+        data = f.read()
+    pid, status = os.waitpid(pid, 0)
+    if data:
+        result, seconds = pickle.loads(data)
+    else:
+        message = '{0} crashed ({1})'.format(test.__name__,
+                                             describe_exit(status))
+        result, seconds = ('C', 'Crash', message, []), 0.0
+    _fork_totals[0] += 1
+    _fork_totals[1] += time() - t0 - seconds
+    return result
+
 def run_test_with_arguments(test, args):
     """Return the result of invoking a test with the given arguments."""
     try:
@@ -146,6 +821,8 @@ def run_test_with_arguments(test, args):
     else:
         return '.'
 
+    # Our import hook has usually rewritten the test's asserts already;
+    # if not, rewrite them now and re-run the test to learn the details.
     if (not message) and function and not hasattr(function, 'assay_rewritten'):
         rewrite_asserts_in(function)
         function.assay_rewritten = True
@@ -173,7 +850,9 @@ def traceback_frames(tb=None, return_top_frame=False):
 
     The result is a list of tuples in the usual style of extract_tb(tb),
     except that a bonus tuple is added in the case of a SyntaxError.  If
-    `return_top_frame` is true, a frame object is also returned.
+    `return_top_frame` is true, a frame object is also returned.  The
+    traceback ends at the assert that failed, even if a rewritten assert
+    then called the comparison machinery of ``unittest``.
 
     """
     e = None
@@ -181,9 +860,11 @@ def traceback_frames(tb=None, return_top_frame=False):
         etype, e, tb = sys.exc_info()
     tuples = []
     while tb is not None:
-        frame = tb.tb_frame
-        code = frame.f_code
+        code = tb.tb_frame.f_code
         filename = code.co_filename
+        if _is_comparison_filename(filename):
+            break
+        frame = tb.tb_frame
         if not _is_noisy_filename(filename):
             lineno = tb.tb_lineno
             line = linecache.getline(filename, lineno, frame.f_globals)
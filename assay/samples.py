@@ -1,12 +1,41 @@
 """Sample tests for the Assay test suite to exercise."""
 
+import os
+import threading
 from assay import assert_raises
+from time import sleep
 
 flags = set()
 
 def mul(a, b):
     return a * b
 
+def pause_between(first, second, seconds):
+    yield first
+    sleep(seconds)
+    yield second
+
+def pause_after(items, seconds):
+    for item in items:
+        yield item
+    sleep(seconds)
+
+def fork_sleeper(seconds):
+    pid = os.fork()
+    if not pid:
+        sleep(seconds)
+        os._exit(0)
+    return pid
+
+def count_threads(n, seconds):
+    for i in range(n):
+        yield threading.active_count()
+        sleep(seconds)
+
+def dots(n, size):
+    for i in range(n):
+        yield '.' * size
+
 def test_passing():
     pass
 
@@ -0,0 +1,244 @@
+"""Decide which worker runs which tests."""
+
+from collections import OrderedDict
+from .history import History, longest_first
+from .runner import split_test_item
+
+class Scheduler(object):
+    """Hand out test modules, and chunks of their tests, to idle workers.
+
+    Each job is a tuple ``(module_name, test_names)``.  A module starts
+    out as a job whose `test_names` is None, asking a worker to import
+    the module and list its tests.  Once `split()` learns the names,
+    the tests are divided into chunks that other workers can pick up
+    if they would otherwise sit idle at the end of the run.
+
+    Modules are handed out longest-first, according to the durations
+    that the `history` remembers from previous runs.  A test with many
+    cases, that would make a chunk of its own, can itself be divided
+    into ranges of cases, so that its cases run on several workers.
+
+    Tests that share a scoped fixture are kept together in the same
+    chunks where possible, and a worker prefers the chunks whose
+    fixtures its process has already built, as the `history` says
+    what each fixture costs to build.
+
+    """
+    def __init__(self, module_names, worker_count, history=None):
+        self.history = History() if history is None else history
+        self.module_names = longest_first(module_names, self.history)
+        self.chunk_count = 2 * worker_count
+        self.chunks = {}        # module name -> list of pending chunks
+        self.imported = {}      # worker -> names of modules it imported
+        self.uses = {}          # module name -> test name -> fixture keys
+        self.built = {}         # worker -> keys of fixtures it has built
+
+    def next_job(self, worker):
+        """Return the next job for `worker`, or None if nothing is left.
+
+        A worker prefers chunks of a module that it has already
+        imported; then a fresh module; and only then does it import
+        someone else's module to help finish it.
+
+        """
+        imported = self.imported.setdefault(worker, set())
+        job = self.pop_chunk(worker, imported)
+        if job is None and self.module_names:
+            module_name = self.module_names.pop()
+            imported.add(module_name)
+            job = module_name, None
+        if job is None:
+            job = self.pop_chunk(worker, list(self.chunks))
+            if job is not None:
+                imported.add(job[0])
+        if job is not None:
+            self.note_fixtures(worker, *job)
+        return job
+
+    def pop_chunk(self, worker, module_names):
+        """Pop a chunk of one of the modules, or return None if none is left.
+
+        The chunk chosen is the one whose fixtures `worker` has already
+        built, at the greatest cost, while avoiding chunks whose fixtures
+        only some other worker has built, as that worker can run them more
+        cheaply; otherwise the first chunk found is chosen.
+
+        """
+        built = self.built.get(worker, ())
+        elsewhere = set()
+        for other, keys in self.built.items():
+            if other != worker:
+                elsewhere.update(keys)
+        best = None
+        for module_name in module_names:
+            for i, chunk in enumerate(self.chunks.get(module_name, ())):
+                saving = 0.0
+                for key in self.fixtures_of(module_name, chunk):
+                    if key in built:
+                        saving += self.history.fixture_cost(key)
+                    elif key in elsewhere:
+                        saving -= self.history.fixture_cost(key)
+                if best is None or saving > best[0]:
+                    best = saving, module_name, i
+        if best is None:
+            return None
+        saving, module_name, i = best
+        return module_name, self.chunks[module_name].pop(i)
+
+    def fixtures_of(self, module_name, test_names):
+        """Return the keys of the scoped fixtures that tests will build."""
+        uses = self.uses.get(module_name, {})
+        keys = set()
+        for item in test_names:
+            keys.update(uses.get(split_test_item(item)[0], ()))
+        return keys
+
+    def note_fixtures(self, worker, module_name, test_names):
+        """Update which fixtures `worker` holds, once it runs a job.
+
+        Running tests of a module ends the module scope of any other.
+
+        """
+        built = set(key for key in self.built.get(worker, ())
+                    if key[0] is None or key[0] == module_name)
+        if test_names is not None:
+            built.update(self.fixtures_of(module_name, test_names))
+        self.built[worker] = built
+
+    def split(self, module_name, test_names, case_counts=None, uses=None):
+        """Divide the tests of a module into chunks for later jobs.
+
+        The `case_counts` dictionary gives the number of cases of each
+        parametrized test, which can then be split into ranges of cases.
+        The `uses` dictionary gives the keys of the scoped fixtures that
+        each test needs, so that tests sharing them can be kept together.
+
+        """
+        weights = self.history.weights(module_name, test_names, case_counts)
+        items, weights = fan_out(test_names, weights, case_counts or {},
+                                 self.chunk_count)
+        if uses:
+            self.uses[module_name] = uses
+            items, weights = group_by_fixture(
+                items, weights, uses, self.history.fixture_cost)
+        self.chunks[module_name] = split_by_weight(
+            items, weights, self.chunk_count)
+
+    def tests_worth_counting(self, module_name):
+        """Return the names of tests whose cases might be worth dividing.
+
+        Counting a test's cases means calling its fixtures, so it is
+        only done for tests that took about two chunks' worth of their
+        module's time last run, as `fan_out()` divides no others.
+
+        """
+        tests = self.history.durations.get(module_name, {})
+        total = sum(seconds for name, seconds in tests.items()
+                    if name is not None)
+        if not total:
+            return []
+        return sorted(name for name, seconds in tests.items()
+                      if name is not None
+                      and seconds / total * self.chunk_count >= 1.5)
+
+    def requeue(self, worker, module_name, test_names):
+        """Handle a worker that lost its process while running a job.
+
+        The worker's new process has imported nothing, and the tests
+        that it had not yet reached become a chunk of their own.
+
+        """
+        self.forget_imports(worker)
+        if test_names:
+            self.chunks.setdefault(module_name, []).insert(0, test_names)
+
+    def forget_imports(self, worker):
+        """Note that `worker` has a fresh process, which imported nothing."""
+        self.imported[worker] = set()
+        self.built[worker] = set()
+
+def fan_out(test_names, weights, case_counts, n):
+    """Divide tests that are heavy enough into ranges of their cases.
+
+    A test that is expected to take up k of the `n` chunks is replaced by
+    k tuples ``(name, start, stop)``, as long as it has k cases.  Returns
+    the new list of tests, and a list of their weights.
+
+    >>> fan_out(['a', 'b'], [1.0, 3.0], {'b': 10}, 4)
+    (['a', ('b', 0, 3), ('b', 3, 6), ('b', 6, 10)], [1.0, 1.0, 1.0, 1.0])
+
+    """
+    total = float(sum(weights))
+    items = []
+    item_weights = []
+    for name, weight in zip(test_names, weights):
+        count = case_counts.get(name, 1)
+        k = min(count, int(round(weight / total * n))) if total else 1
+        if k < 2:
+            items.append(name)
+            item_weights.append(weight)
+            continue
+        for i in range(k):
+            items.append((name, count * i // k, count * (i + 1) // k))
+            item_weights.append(weight / k)
+    return items, item_weights
+
+def group_by_fixture(items, weights, uses, fixture_cost):
+    """Reorder tests so that those sharing a costly fixture are adjacent.
+
+    Each test joins the group of the costliest scoped fixture that the
+    `uses` dictionary says it needs, and the groups are kept in the
+    order of their first tests.  As only a group's first test will pay
+    to build its fixture, that cost is added to its weight, so that the
+    chunks later cut from the list are still balanced.
+
+    >>> uses = {'a': ['x'], 'b': ['y'], 'c': ['x', 'y']}
+    >>> cost = {'x': 2.0, 'y': 0.5}.get
+    >>> group_by_fixture(['a', 'b', 'c', 'd'], [1, 1, 1, 1], uses, cost)
+    (['a', 'c', 'b', 'd'], [3.0, 1, 1.5, 1])
+
+    """
+    groups = OrderedDict()
+    for item, weight in zip(items, weights):
+        keys = uses.get(split_test_item(item)[0])
+        if keys:
+            key = max(keys, key=lambda key: (fixture_cost(key), repr(key)))
+            group = 'fixture', key
+        else:
+            group = 'test', item
+        groups.setdefault(group, []).append((item, weight))
+    items = []
+    item_weights = []
+    for (kind, key), members in groups.items():
+        for i, (item, weight) in enumerate(members):
+            if kind == 'fixture' and i == 0:
+                weight += fixture_cost(key)
+            items.append(item)
+            item_weights.append(weight)
+    return items, item_weights
+
+def split_by_weight(items, weights, n):
+    """Split a list into at most `n` contiguous chunks of similar weight.
+
+    >>> split_by_weight(['a', 'b', 'c', 'd', 'e'], [1, 1, 1, 1, 1], 3)
+    [['a', 'b'], ['c', 'd'], ['e']]
+    >>> split_by_weight(['a', 'b', 'c', 'd', 'e'], [4, 1, 1, 1, 1], 2)
+    [['a'], ['b', 'c', 'd', 'e']]
+
+    """
+    total = float(sum(weights))
+    if not total:
+        weights = [1] * len(items)
+        total = float(len(items))
+    chunks = []
+    chunk = []
+    running_total = 0.0
+    for item, weight in zip(items, weights):
+        chunk.append(item)
+        running_total += weight
+        if running_total >= total * (len(chunks) + 1) / n:
+            chunks.append(chunk)
+            chunk = []
+    if chunk:
+        chunks.append(chunk)
+    return chunks
@@ -5,24 +5,64 @@ To run these tests, simply invoke::
     $ python -m assay.tests
 
 """
+import gc
+import io
+import marshal
 import os
+import select
 import shutil
 import sys
 import tempfile
+import types
+import warnings
 from contextlib import contextmanager
-from . import samples
+from time import sleep, time
+from . import fixture, rewriting, runner, samples, worker
+from .assertion import (code_for_marshal, code_from_marshal, find_asserts,
+                        rewrite_asserts_in_code, rewrite_bytecode,
+                        rewrite_bytecode_with_pattern)
+from .combinations import (covering_array, each_value, parse_strategy,
+                           random_sample)
 from .compatibility import get_code, unittest
-from .discovery import interpret_argument
-from .importation import improve_order, list_module_paths
-from .runner import run_tests_of, run_test
-from .samples import mul
-from .worker import Worker
+from .dependencies import Dependencies
+from .discovery import interpret_argument, search_argument
+from .history import History
+from .limits import Limits, set_rlimits
+from .preloading import LearnedOrder, Levels
+from .importation import (import_graph, improve_order, list_module_paths,
+                          take_new_imports)
+from .runner import (OUTPUT_HEAD, OUTPUT_TAIL, capture_stdout_stderr,
+                     clear_fixture_cache, fixture_cache, list_tests_of,
+                     run_tests_of, run_test)
+from .samples import mul, pause_between
+from .replay import ResultCache
+from .scheduler import Scheduler
+from .timeouts import Timeouts, parse_stack
+from .unix import cpu_count, resident_memory
+from .worker import Worker, launch_workers
 
 _python3 = sys.version_info >= (3,)
 _python33 = sys.version_info >= (3, 3)
 _python38 = sys.version_info >= (3, 8)
 _python3_11 = sys.version_info >= (3, 11)
 
+_old_cache_dir = None
+_cache_dir = None
+
+def setUpModule():
+    """Keep the caches that the tests and their workers write private."""
+    global _old_cache_dir, _cache_dir
+    _old_cache_dir = os.environ.get('ASSAY_CACHE_DIR')
+    _cache_dir = tempfile.mkdtemp(prefix='assaycache')
+    os.environ['ASSAY_CACHE_DIR'] = _cache_dir
+
+def tearDownModule():
+    if _old_cache_dir is None:
+        del os.environ['ASSAY_CACHE_DIR']
+    else:
+        os.environ['ASSAY_CACHE_DIR'] = _old_cache_dir
+    shutil.rmtree(_cache_dir)
+
 # Tests.
 
 class DiscoveryTests(unittest.TestCase):
@@ -145,6 +185,12 @@ class DiscoveryTests(unittest.TestCase):
         assert 'p1' not in d
         assert d['p1.p2'] == self.path('p1', 'p2', '__init__.py')
 
+    def test_search_gives_the_source_path_of_each_module(self):
+        paths = dict(search_argument(self.path(), 'p1.p2'))
+        self.assertEqual(paths['p1.p2'],
+                         self.path('p1', 'p2', '__init__.py'))
+        self.assertEqual(paths['p1.p2.m5'], self.path('p1', 'p2', 'm5.py'))
+
 
 class RunnerTests(unittest.TestCase):
 
@@ -154,6 +200,29 @@ class RunnerTests(unittest.TestCase):
         value = list(run_tests_of('assay.samples'))
         self.assertEqual(len(value), 37)
 
+    def test_runner_on_selected_tests(self):
+        value = list(run_tests_of('assay.samples', ['test_passing',
+                                                    'test_fix2']))
+        self.assertEqual(len(value), 5)
+        self.assertEqual(value[0], '.')
+
+    def test_listing_tests(self):
+        value = list(list_tests_of('assay.samples'))
+        self.assertEqual(len(value), 1)
+        self.assertEqual(len(value[0]), 32)
+        self.assertEqual(value[0][:2], ['test_assert0', 'test_assert1'])
+
+    def test_listing_counts_the_cases_of_parametrized_tests(self):
+        value = list(list_tests_of('assay.samples',
+                                   count_cases=['test_fix2', 'test_fix3']))
+        self.assertEqual(len(value), 2)
+        self.assertEqual(value[0], {'test_fix2': 4})
+
+    def test_running_a_range_of_cases(self):
+        value = list(run_tests_of('assay.samples', [('test_fix2', 1, 3)]))
+        self.assertEqual([result[0] for result in value], ['.', 'E'])
+        self.assertEqual(value[1][3][0][2], 'test_fix2(2)')
+
     def test_runner_on_syntax_error(self):
         with tempfile.NamedTemporaryFile(suffix='.py') as f:
             f.write(b'\n\nif while\n')
@@ -199,6 +268,251 @@ class RunnerTests(unittest.TestCase):
             ])
 
 
+def noisy_results(size):
+    os.write(1, b'from fd 1\n')
+    sys.stderr.write('from sys.stderr\n')
+    yield ('F',)
+    os.write(1, b'x' * size)
+    yield '.'
+    os.write(1, b'a' + b'x' * size + b'z')
+    yield ('F',)
+
+class CaptureTests(unittest.TestCase):
+
+    def test_capture_of_file_descriptors(self):
+        size = OUTPUT_HEAD + OUTPUT_TAIL
+        results = list(capture_stdout_stderr(noisy_results, size))
+        self.assertEqual(results[0], ('F', 'from fd 1\n', 'from sys.stderr\n'))
+        self.assertEqual(results[1], '.')
+        character, out, err = results[2]
+        self.assertEqual(out[0], 'a')
+        self.assertEqual(out[-1], 'z')
+        self.assertIn('[... 2 bytes omitted; full output in ', out)
+        path = out.split(' full output in ')[1].split(' ...]')[0]
+        self.assertEqual(os.path.getsize(path), size + 2)
+        self.assertEqual(os.path.dirname(path),
+                         os.path.join(os.environ['ASSAY_CACHE_DIR'], 'output'))
+
+    def test_only_the_latest_output_logs_are_kept(self):
+        directory = tempfile.mkdtemp(prefix='assaytest')
+        try:
+            for i in range(5):
+                path = os.path.join(directory, 'log{0}'.format(i))
+                open(path, 'w').close()
+                os.utime(path, (i, i))
+            runner.prune_logs(directory, 2)
+            self.assertEqual(sorted(os.listdir(directory)), ['log3', 'log4'])
+        finally:
+            shutil.rmtree(directory)
+
+def fixture_module(name, events):
+    """Build a test module whose scoped fixtures record `events`."""
+    module = types.ModuleType(name)
+
+    @fixture('module')
+    def db():
+        events.append('setup')
+        yield 'db'
+        events.append('teardown')
+
+    @fixture('session')
+    def numbers():
+        events.append('numbers')
+        return [1, 2]
+
+    def test_one(db, numbers):
+        pass
+
+    def test_two(db):
+        pass
+
+    module.db = db
+    module.numbers = numbers
+    module.test_one = test_one
+    module.test_two = test_two
+    return module
+
+class FixtureCacheTests(unittest.TestCase):
+
+    def tearDown(self):
+        clear_fixture_cache()
+
+    def run_module(self, module):
+        results = []
+        for test in module.test_one, module.test_two:
+            results.extend(run_test(module, test))
+        return results
+
+    def test_scoped_fixture_is_called_once_and_torn_down_at_the_end(self):
+        events = []
+        module = fixture_module('m1', events)
+        self.assertEqual(self.run_module(module), ['.', '.', '.'])
+        self.assertEqual(events, ['setup', 'numbers'])
+        failures = clear_fixture_cache()
+        self.assertEqual(failures, [[4, 2]])
+        self.assertEqual(events, ['setup', 'numbers', 'teardown'])
+
+    def test_module_scope_ends_when_another_module_runs(self):
+        events = []
+        self.run_module(fixture_module('m1', events))
+        self.assertEqual(fixture_cache.end_modules_other_than('m1'), [])
+        self.assertEqual(events, ['setup', 'numbers'])
+        self.assertEqual(fixture_cache.end_modules_other_than('m2'), [])
+        self.assertEqual(events, ['setup', 'numbers', 'teardown'])
+
+    def test_teardown_failure_names_the_module_that_used_the_fixture(self):
+        module = types.ModuleType('m1')
+        def broken():
+            yield 'value'
+            raise ValueError('cannot tear down')
+        module.broken = fixture('module')(broken)
+        def test_broken(broken):
+            pass
+        self.assertEqual(list(run_test(module, test_broken)), ['.'])
+        failures = fixture_cache.end_modules_other_than('m2')
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(failures[0].module_name, 'm1')
+        self.assertEqual(failures[0].failure[:2], ('F', 'ValueError'))
+
+    def test_fixtures_are_evicted_when_memory_is_low(self):
+        events = []
+        self.run_module(fixture_module('m1', events))
+        old_low_memory = runner.LOW_MEMORY
+        runner.LOW_MEMORY = float('inf')
+        try:
+            self.assertEqual(fixture_cache.evict_if_memory_is_low(), [])
+        finally:
+            runner.LOW_MEMORY = old_low_memory
+        self.assertEqual(fixture_cache.entries, {})
+        self.assertEqual(events, ['setup', 'numbers', 'teardown'])
+
+class FixtureGraphTests(unittest.TestCase):
+
+    def tearDown(self):
+        clear_fixture_cache()
+
+    def test_shared_upstream_fixture_is_built_once(self):
+        events = []
+        module = types.ModuleType('m1')
+        def base():
+            events.append('base')
+            return [1, 2]
+        module.base = base
+        module.doubled = lambda base: [base * 2]
+        module.negated = lambda base: [-base, base]
+        def test_sum(doubled, negated, base):
+            pass
+        results = list(run_test(module, test_sum))
+        self.assertEqual(results, ['.'] * 16)
+        self.assertEqual(events, ['base'])
+        fixtures, upstreams = runner.fixture_graph(module).resolve(
+            ['doubled', 'negated'])
+        self.assertEqual(upstreams, [[[1, 2]], [[1, 2]]])
+        self.assertTrue(runner.fixture_graph(module)
+                        is runner.fixture_graph(module))
+
+    def test_scoped_fixture_can_take_a_scoped_fixture(self):
+        events = []
+        module = fixture_module('m1', events)
+        module.total = fixture('module')(lambda numbers: [numbers * 10])
+        def test_total(total):
+            assert total < 15
+        results = list(run_test(module, test_total))
+        self.assertEqual(results[0], '.')
+        self.assertEqual(results[1][:3], ('E', 'AssertionError', '20 not less than 15'))
+        self.assertEqual(list(run_test(module, test_total))[0], '.')
+        self.assertEqual(events, ['numbers'])
+
+    def test_cycle_is_reported(self):
+        module = types.ModuleType('m1')
+        module.a = lambda b: [b]
+        module.b = lambda c: [c]
+        module.c = lambda a: [a]
+        def test_a(a):
+            pass
+        results = list(run_test(module, test_a))
+        self.assertEqual(results[0][:3], (
+            'F', 'Failure', 'fixtures form a cycle: a -> b -> c -> a'))
+
+    def test_scoped_fixture_cannot_take_a_narrower_fixture(self):
+        module = types.ModuleType('m1')
+        module.plain = [1]
+        module.wide = fixture('session')(lambda plain: [plain])
+        def test_wide(wide):
+            pass
+        results = list(run_test(module, test_wide))
+        self.assertEqual(results[0][:3], (
+            'F', 'Failure', "session-scoped fixture 'wide' cannot take"
+            " the narrower fixture 'plain'"))
+
+    def test_setup_costs_are_reported_with_the_fixtures_tests_use(self):
+        events = []
+        module = fixture_module('m1', events)
+        module.total = fixture('module')(lambda numbers: [numbers * 10])
+        module.test_three = lambda total: None
+        tests = [('test_one', module.test_one),
+                 ('test_three', module.test_three)]
+        uses = runner.scoped_fixtures_of(module, tests)
+        numbers = (None, __name__ + '.numbers')
+        self.assertEqual(uses, {
+            'test_one': [('m1', __name__ + '.db'), numbers],
+            'test_three': [('m1', __name__ + '.<lambda>'), numbers],
+            })
+        self.assertEqual(fixture_cache.take_setup_seconds(), {})
+        list(run_test(module, module.test_one))
+        seconds = fixture_cache.take_setup_seconds()
+        self.assertEqual(sorted(seconds, key=repr), uses['test_one'])
+        self.assertEqual(fixture_cache.take_setup_seconds(), {})
+
+class IsolationTests(unittest.TestCase):
+
+    def tearDown(self):
+        clear_fixture_cache()
+
+    def test_isolated_tests_each_see_a_pristine_fixture(self):
+        module = types.ModuleType('m1')
+        module.items = fixture('module')(lambda: [[]])
+        def test_append(items):
+            items.append(1)
+            assert items == [1]
+        results = []
+        for isolated in True, True, False, False:
+            results.extend(run_test(module, test_append, isolated))
+        self.assertEqual([result[0] for result in results],
+                         ['.', '.', '.', 'E'])
+
+    def test_crash_of_an_isolated_test_is_reported(self):
+        module = types.ModuleType('m1')
+        def test_exit():
+            os._exit(3)
+        result = list(run_test(module, test_exit, True))
+        self.assertEqual(result, [
+            ('C', 'Crash', 'test_exit crashed (exit status 3)', []),
+        ])
+
+    def test_timing_counts_the_forks(self):
+        results = list(run_tests_of('assay.samples', ['test_passing'],
+                                    timed=True, isolated=True))
+        self.assertEqual(results[0], '.')
+        self.assertEqual(results[1].forks, 1)
+        self.assertTrue(results[1].fork_seconds > 0.0)
+
+    def test_worker_forks_isolated_tests_with_no_other_thread_running(self):
+        w = Worker()
+        try:
+            w.call(warnings.simplefilter, 'default')  # show fork() warnings
+            w.start(capture_stdout_stderr, run_tests_of, 'assay.samples',
+                    ['test_passing', 'test_assert0'], isolated=True)
+            results = []
+            while StopIteration not in results:
+                select.select([w], [], [])
+                results.extend(w.receive())
+        finally:
+            w.close()
+        self.assertEqual(results[0], '.')
+        self.assertEqual(results[1][0], 'E')
+        self.assertEqual(results[1][-2:], ('', ''))
+
 class ErrorMessageTests(unittest.TestCase):
 
     maxDiff = 10000
@@ -504,6 +818,304 @@ class ErrorMessageTests(unittest.TestCase):
             ]),
         ])
 
+@unittest.skipIf(sys.version_info < (3, 6), 'needs two-byte instructions')
+class FindAssertsTests(unittest.TestCase):
+
+    def test_finds_the_same_asserts_as_the_pattern(self):
+        for name in dir(samples):
+            function = getattr(samples, name)
+            if not hasattr(function, '__code__'):
+                continue
+            bytecode = function.__code__.co_code
+            self.assertEqual(rewrite_bytecode(bytecode, 5),
+                             rewrite_bytecode_with_pattern(bytecode, 5))
+
+    def test_ignores_bytes_that_straddle_instructions(self):
+        bytecode = compile('assert a == 2\n', 'a.py', 'exec').co_code
+        self.assertEqual(len(list(find_asserts(bytecode))), 1)
+        self.assertEqual(list(find_asserts(b'\0' + bytecode[:-1])), [])
+
+HOOKED_MODULE = """
+flags = []
+
+def test_once():
+    flags.append(1)
+    assert len(flags) == 2
+    flags.append(2)
+"""
+
+class ImportHookTests(unittest.TestCase):
+
+    @unittest.skipIf(rewriting.MetaPathFinder is None, 'needs importlib')
+    def test_first_failure_explains_itself(self):
+        from importlib.util import module_from_spec, spec_from_loader
+        with tempfile.NamedTemporaryFile('w', suffix='.py') as f:
+            f.write(HOOKED_MODULE)
+            f.flush()
+            loader = rewriting.AssertRewritingLoader('hooked', f.name)
+            module = module_from_spec(spec_from_loader('hooked', loader))
+            loader.exec_module(module)
+        result = list(run_test(module, module.test_once))
+        self.assertEqual(result[0][:3], ('E', 'AssertionError', '1 != 2'))
+        self.assertEqual([frame[2] for frame in result[0][3]],
+                         ['test_once'])
+        self.assertEqual(module.flags, [1])
+
+    @unittest.skipIf(rewriting.MetaPathFinder is None, 'needs importlib')
+    def test_rewritten_code_survives_marshalling(self):
+        source = HOOKED_MODULE + 'def test_tuple():\n    assert 3 in ()\n'
+        code = rewrite_asserts_in_code(compile(source, 'hooked.py', 'exec'))
+        data = marshal.dumps(code_for_marshal(code))
+        namespace = {}
+        exec(code_from_marshal(marshal.loads(data)), namespace)
+        result = list(run_test(samples, namespace['test_tuple']))
+        self.assertEqual(result[0][:3],
+                         ('E', 'AssertionError', '3 not found in ()'))
+
+class SchedulerTests(unittest.TestCase):
+
+    def test_each_module_is_listed_before_it_is_split(self):
+        s = Scheduler(['m1', 'm2'], 2)
+        self.assertEqual(s.next_job('w1'), ('m2', None))
+        self.assertEqual(s.next_job('w2'), ('m1', None))
+        self.assertEqual(s.next_job('w1'), None)
+
+    def test_worker_prefers_chunks_of_a_module_it_already_imported(self):
+        s = Scheduler(['m1', 'm2'], 1)
+        self.assertEqual(s.next_job('w1'), ('m2', None))
+        s.split('m2', ['t1', 't2', 't3'])
+        self.assertEqual(s.next_job('w1'), ('m2', ['t1', 't2']))
+        self.assertEqual(s.next_job('w2'), ('m1', None))
+        self.assertEqual(s.next_job('w2'), ('m2', ['t3']))
+        self.assertEqual(s.next_job('w1'), None)
+
+    def test_modules_are_scheduled_longest_first(self):
+        history = History({'m1': {None: 0.1, 't1': 5.0},
+                           'm2': {None: 0.1, 't1': 1.0}})
+        s = Scheduler(['m1', 'm2', 'm3', 'm4'], 1, history)
+        jobs = [s.next_job('w1') for i in range(4)]
+        self.assertEqual(jobs, [('m4', None), ('m3', None),
+                                ('m1', None), ('m2', None)])
+
+    def test_chunks_are_balanced_by_duration(self):
+        history = History({'m1': {None: 0.1, 't1': 6.0, 't2': 1.0}})
+        s = Scheduler(['m1'], 1, history)
+        s.next_job('w1')
+        s.split('m1', ['t1', 't2', 't3'])
+        self.assertEqual(s.chunks['m1'], [['t1'], ['t2', 't3']])
+
+    def test_test_with_many_cases_is_fanned_out(self):
+        s = Scheduler(['m1'], 2)
+        s.next_job('w1')
+        s.split('m1', ['t1', 't2'], {'t2': 100})
+        self.assertEqual(s.chunks['m1'], [
+            ['t1', ('t2', 0, 25)], [('t2', 25, 50)],
+            [('t2', 50, 75)], [('t2', 75, 100)],
+        ])
+
+    def test_only_tests_that_were_heavy_have_their_cases_counted(self):
+        history = History({'m1': {None: 0.1, 't1': 6.0, 't2': 1.0,
+                                  't3': 1.0}})
+        s = Scheduler(['m1'], 2, history)
+        self.assertEqual(s.tests_worth_counting('m1'), ['t1'])
+        self.assertEqual(s.tests_worth_counting('m2'), [])
+
+    def test_requeued_tests_run_next_in_a_fresh_process(self):
+        s = Scheduler(['m1'], 1)
+        s.next_job('w1')
+        s.split('m1', ['t1', 't2', 't3'])
+        s.next_job('w1')
+        s.requeue('w1', 'm1', ['t2'])
+        self.assertEqual(s.imported['w1'], set())
+        self.assertEqual(s.next_job('w1'), ('m1', ['t2']))
+
+    def test_tests_sharing_a_costly_fixture_go_to_one_worker(self):
+        durations = {'m1': {None: 0.1, 't1': 1.0, 't2': 1.0,
+                            't3': 1.0, 't4': 1.0}}
+        y = (None, 'f.y')
+        z = ('m1', 'f.z')
+        history = History(durations, {y: 5.0, z: 5.0})
+        s = Scheduler(['m1'], 2, history)
+        s.next_job('w1')
+        s.split('m1', ['t1', 't2', 't3', 't4'], None,
+                {'t1': [y], 't2': [z], 't3': [z], 't4': [y]})
+        self.assertEqual(s.chunks['m1'], [['t1'], ['t4'], ['t2'], ['t3']])
+        self.assertEqual(s.next_job('w1'), ('m1', ['t1']))
+        self.assertEqual(s.next_job('w2'), ('m1', ['t2']))
+        self.assertEqual(s.next_job('w2'), ('m1', ['t3']))
+        self.assertEqual(s.next_job('w1'), ('m1', ['t4']))
+        self.assertEqual(s.built, {'w1': set([y]), 'w2': set([z])})
+
+class TimeoutsTests(unittest.TestCase):
+
+    def test_job_deadline_outlives_test_progress(self):
+        timeouts = Timeouts(test_seconds=60.0, job_seconds=0.0)
+        timeouts.start('w1')
+        timeouts.progress('w1')
+        self.assertEqual(timeouts.expired(), [('w1', 0.0)])
+        self.assertEqual(timeouts.seconds_left(), 0.0)
+        timeouts.stop('w1')
+        self.assertEqual(timeouts.expired(), [])
+        self.assertEqual(timeouts.seconds_left(), None)
+
+    def test_stack_is_that_of_the_thread_running_the_test(self):
+        runner_path = run_tests_of.__code__.co_filename
+        text = (
+            'Thread 0x00007f0000000002 (most recent call first):\n'
+            '  File "/usr/lib/python3/threading.py", line 320 in wait\n'
+            '\n'
+            'Current thread 0x00007f0000000001 (most recent call first):\n'
+            '  File "/tmp/test_slow.py", line 3 in helper\n'
+            '  File "/tmp/test_slow.py", line 7 in test_slow\n'
+            '  File "{0}", line 99 in run_test_with_arguments\n'
+            '  File "<frozen runpy>", line 88 in _run_code\n'
+        ).format(runner_path)
+        frames = parse_stack(text)
+        self.assertEqual([frame[:3] for frame in frames], [
+            ('/tmp/test_slow.py', 7, 'test_slow'),
+            ('/tmp/test_slow.py', 3, 'helper'),
+        ])
+
+class LimitsTests(unittest.TestCase):
+
+    def test_process_is_worn_out_by_modules_or_memory(self):
+        limits = Limits(module_count=3, rss=1000)
+        self.assertFalse(limits.is_worn_out(2, 1000))
+        self.assertTrue(limits.is_worn_out(3, 1000))
+        self.assertTrue(limits.is_worn_out(2, 1001))
+        self.assertFalse(Limits().is_worn_out(100, 10 ** 12))
+
+    @unittest.skipIf(not Limits(open_files=1).rlimits(), 'needs resource')
+    def test_limits_apply_only_to_the_test_process(self):
+        rlimits = Limits(open_files=64).rlimits()
+        get_limit = '__import__("resource").getrlimit({0})[0]'.format(
+            rlimits[0][0])
+        w = Worker()
+        try:
+            original = w.call(eval, get_limit)
+            w.push()
+            w.call(set_rlimits, rlimits)
+            self.assertEqual(w.call(eval, get_limit), 64)
+            w.pop()
+            self.assertEqual(w.call(eval, get_limit), original)
+        finally:
+            w.close()
+
+    @unittest.skipIf(not Limits(cpu_seconds=1).rlimits(), 'needs resource')
+    def test_cpu_limit_counts_from_when_it_is_set(self):
+        rlimits = Limits(cpu_seconds=100).job_rlimits()
+        self.assertEqual(len(rlimits), 1)
+        get_limit = '__import__("resource").getrlimit({0})[0]'.format(
+            rlimits[0][0])
+        get_usage = ('sum(__import__("resource").getrusage(0)[:2])')
+        w = Worker()
+        try:
+            w.push()
+            w.call(eval, 'sum(range(10 ** 6))')
+            w.call(set_rlimits, rlimits)
+            first = w.call(eval, get_limit)
+            self.assertTrue(first > 100)
+            w.call(eval, 'sum(range(10 ** 7))')
+            used = w.call(eval, get_usage)
+            w.call(set_rlimits, rlimits)
+            second = w.call(eval, get_limit)
+            self.assertTrue(100 + used <= second <= 101 + used)
+        finally:
+            w.close()
+
+class CombinationsTests(unittest.TestCase):
+
+    def test_covering_array_covers_every_pair(self):
+        sizes = [3, 4, 2, 3, 3]
+        cases = covering_array(sizes, 2)
+        self.assertTrue(len(cases) < 3 * 4 * 2 * 3 * 3)
+        for i, j in [(0, 1), (1, 2), (0, 4), (3, 4)]:
+            pairs = set((case[i], case[j]) for case in cases)
+            self.assertEqual(len(pairs), sizes[i] * sizes[j])
+
+    def test_each_value_appears(self):
+        cases = each_value([2, 5, 1])
+        self.assertEqual(len(cases), 5)
+        self.assertEqual(set(case[1] for case in cases), set(range(5)))
+
+    def test_random_sample_is_reproducible(self):
+        cases = random_sample([10, 10, 10], 20, 42)
+        self.assertEqual(len(set(cases)), 20)
+        self.assertEqual(cases, sorted(cases))
+        self.assertEqual(cases, random_sample([10, 10, 10], 20, 42))
+
+    def test_random_sample_of_a_huge_product(self):
+        cases = random_sample([50] * 10, 100, 1)
+        self.assertEqual(len(set(cases)), 100)
+        self.assertEqual(cases, sorted(cases))
+
+    def test_failure_says_how_to_choose_the_case_again(self):
+        results = list(run_test(samples, samples.test_fix2, False, None,
+                                parse_strategy('each')))
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[2][2], '2 == 2 [case chosen by each value'
+                         ' at least once; rerun with --cases each]')
+
+    def test_random_strategy_keeps_its_seed(self):
+        self.assertEqual(parse_strategy('random:2:3').argument(), 'random:2:3')
+
+    def test_bad_strategy_is_rejected(self):
+        self.assertRaises(ValueError, parse_strategy, 'random:0')
+        self.assertRaises(ValueError, parse_strategy, 'fourwise')
+
+class HistoryTests(unittest.TestCase):
+
+    def test_listing_forgets_tests_that_have_been_removed(self):
+        history = History({'m1': {None: 0.1, 't1': 3.0, 't2': 1.0}})
+        history.record_listing('m1', ['t2', 't3'], 0.2)
+        self.assertEqual(history.durations, {'m1': {None: 0.2, 't2': 1.0}})
+        self.assertEqual(history.estimate('m1'), 1.2)
+        self.assertEqual(history.estimate('m2'), None)
+
+class ResultCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='assaytest')
+        self.old_cache_dir = os.environ.get('ASSAY_CACHE_DIR')
+        os.environ['ASSAY_CACHE_DIR'] = os.path.join(self.directory, 'cache')
+        self.path = os.path.join(self.directory, 'm.py')
+        self.write_source('x = 1\n')
+
+    def tearDown(self):
+        if self.old_cache_dir is None:
+            del os.environ['ASSAY_CACHE_DIR']
+        else:
+            os.environ['ASSAY_CACHE_DIR'] = self.old_cache_dir
+        shutil.rmtree(self.directory)
+
+    def write_source(self, text):
+        with open(self.path, 'w') as f:
+            f.write(text)
+
+    def test_results_are_replayed_until_an_imported_file_changes(self):
+        result_cache = ResultCache()
+        result_cache.store('test_m', [self.path], ['.', '.'])
+        result_cache.save()
+        self.assertEqual(ResultCache.load().lookup('test_m'), ['.', '.'])
+        self.write_source('x = 2\n')
+        self.assertEqual(ResultCache.load().lookup('test_m'), None)
+        self.write_source('x = 1\n')
+        self.assertEqual(ResultCache.load().lookup('test_m'), ['.', '.'])
+
+    def test_results_are_only_replayed_for_the_same_cases(self):
+        result_cache = ResultCache(variant='pairwise')
+        result_cache.store('test_m', [self.path], ['.'])
+        result_cache.save()
+        self.assertEqual(ResultCache.load('pairwise').lookup('test_m'), ['.'])
+        self.assertEqual(ResultCache.load().lookup('test_m'), None)
+
+    def test_least_recently_used_results_are_evicted(self):
+        result_cache = ResultCache()
+        result_cache.max_bytes = 1
+        result_cache.store('test_m', [self.path], ['.'])
+        result_cache.save()
+        self.assertEqual(ResultCache.load().lookup('test_m'), None)
+
 class ImproveOrderTests(unittest.TestCase):
 
     # We assume that module B imports A, C imports B, D imports C, et
@@ -596,20 +1208,153 @@ class ImproveOrderTests(unittest.TestCase):
         self.assertEqual(improve_order(events),
                          ['A', 'X', 'B', 'C', 'Y', 'Z', 'D', 'E'])
 
-PRETEND_PIPE_LIMIT = 256
+class PreloadingTests(unittest.TestCase):
 
-class BlockReader(object):
-    """Challenge: can we survive a pipe that splits long data into blocks?"""
-    def __init__(self, file):
-        self.file = file
-        self.close = file.close
+    def test_invalidating_a_level_pops_it_and_the_levels_above(self):
+        directory = tempfile.mkdtemp(prefix='assaytest')
+        path = os.path.join(directory, 'preloadme.py')
+        with open(path, 'w') as f:
+            f.write('import json\n')
+        messages = []
+        w = Worker()
+        try:
+            w.call(eval, '__import__("sys").path.insert(0, {0!r})'
+                   .format(directory))
+            levels = Levels([w], [['preloadme'], ['nosuch'], []],
+                            messages.append)
+            levels.push()
+            self.assertEqual(len(w.pids), 4)
+            self.assertIn(path, levels.paths[0])
+            self.assertEqual(len(messages), 1)
+            self.assertFalse(levels.invalidate(['/nonexistent.py']))
+            self.assertTrue(levels.invalidate([path]))
+            self.assertEqual(len(w.pids), 1)
+            levels.push()
+            self.assertEqual(len(w.pids), 4)
+        finally:
+            w.close()
+            shutil.rmtree(directory)
+
+    def test_module_that_starts_a_thread_is_left_out_of_its_level(self):
+        directory = tempfile.mkdtemp(prefix='assaytest')
+        path = os.path.join(directory, 'threadme.py')
+        with open(path, 'w') as f:
+            f.write('import threading, time\n'
+                    't = threading.Thread(target=time.sleep, args=(60,))\n'
+                    't.daemon = True\n'
+                    't.start()\n')
+        messages = []
+        w = Worker()
+        try:
+            w.call(eval, '__import__("sys").path.insert(0, {0!r})'
+                   .format(directory))
+            levels = Levels([w], [['threadme', 'json']], messages.append)
+            levels.push()
+            self.assertEqual(len(w.pids), 2)
+            self.assertEqual(len(messages), 1)
+            self.assertIn('thread', messages[0])
+            modules = w.call(eval, 'list(__import__("sys").modules)')
+            self.assertNotIn('threadme', modules)
+            self.assertIn('json', modules)
+            self.assertNotIn(path, levels.paths[0])
+        finally:
+            w.close()
+            shutil.rmtree(directory)
+
+class LearnedOrderTests(unittest.TestCase):
+
+    def test_observed_modules_are_appended_unless_excluded(self):
+        learned = LearnedOrder(['A'])
+        learned.observe([('A', 'a.py'), ('B', 'b.py'), ('T', 't.py'),
+                         ('__main__', 'w.py'), ('C', 'c.py')], set(['T']))
+        self.assertEqual(learned.module_names(), ['A', 'B', 'C'])
+
+    def test_learning_moves_modules_after_their_side_effects(self):
+        learned = LearnedOrder(['A', 'C', 'B'])
+        learned.learn([('A', set('A')), ('C', set('BC')), ('B', set())], [])
+        self.assertEqual(learned.module_names(), ['A', 'B', 'C'])
+
+    def test_packages_are_not_moved_for_importing_their_modules(self):
+        learned = LearnedOrder(['p.m', 'p'])
+        learned.learn([('p.m', set(['p', 'p.m'])), ('p', set())], [])
+        self.assertEqual(learned.module_names(), ['p', 'p.m'])
+        self.assertEqual(learned.moves, {})
+
+    def test_modules_that_fail_or_keep_moving_are_left_out(self):
+        learned = LearnedOrder(['A', 'B', 'C'])
+        for i in range(3):
+            learned.learn([('A', set('A')), ('B', set('BX')), ('C', set())],
+                          [('C', 'ValueError: no')])
+        self.assertEqual(learned.dangers, set('BC'))
+        self.assertEqual(learned.module_names(), ['A', 'X'])
+
+class DependenciesTests(unittest.TestCase):
+
+    def test_changes_affect_tests_that_import_them_at_any_distance(self):
+        dependencies = Dependencies()
+        dependencies.test_module_names = set(['test_a', 'test_b', 'test_c'])
+        dependencies.update(
+            [('a', 'a.py'), ('b', 'b.py'), ('util', 'util.py')],
+            {'test_a': set(['a']), 'test_b': set(['b']),
+             'test_c': set(['os']), 'a': set(['util']), 'b': set(['util'])})
+        self.assertEqual(dependencies.affected(['a.py']), set(['test_a']))
+        self.assertEqual(dependencies.affected(['util.py']),
+                         set(['test_a', 'test_b']))
+        self.assertEqual(dependencies.affected(['other.py']), set())
+
+    def test_worker_records_which_module_imports_which(self):
+        w = Worker()
+        try:
+            w.call(eval, '__import__("assay.samples") and None')
+            graph = w.call(import_graph)
+        finally:
+            w.close()
+        self.assertIn('time', graph['assay.samples'])
+
+    def test_worker_reports_only_what_was_imported_since_last_time(self):
+        directory = tempfile.mkdtemp(prefix='assaytest')
+        with open(os.path.join(directory, 'newmod.py'), 'w') as f:
+            f.write('import colorsys\n')
+        w = Worker()
+        try:
+            w.call(eval, '__import__("sys").path.insert(0, {0!r})'
+                   .format(directory))
+            w.push()
+            module_paths, graph = w.call(take_new_imports)
+            self.assertNotIn('newmod', dict(module_paths))
+            w.call(eval, '__import__("newmod") and None')
+            module_paths, graph = w.call(take_new_imports)
+            self.assertIn('newmod', dict(module_paths))
+            self.assertEqual(graph['newmod'], set(['colorsys']))
+            module_paths, graph = w.call(take_new_imports)
+            self.assertEqual(module_paths, [])
+            self.assertNotIn('newmod', graph)
+        finally:
+            w.close()
+            shutil.rmtree(directory)
+
+class UnixTests(unittest.TestCase):
 
-    def read(self, n=-1):
-        n = min(n, PRETEND_PIPE_LIMIT)
-        return self.file.read(n)
+    def test_cpu_count_respects_affinity(self):
+        count = cpu_count()
+        self.assertTrue(count >= 1)
+        if hasattr(os, 'sched_getaffinity'):
+            self.assertTrue(count <= len(os.sched_getaffinity(0)))
 
-    def readline(self, n=-1):
-        raise NotImplementedError()
+    @unittest.skipIf(not os.path.exists('/proc/self/status'), 'needs /proc')
+    def test_resident_memory_peak_is_at_least_current(self):
+        rss, peak = resident_memory(os.getpid())
+        self.assertTrue(0 < rss <= peak)
+
+PRETEND_PIPE_LIMIT = 256
+
+def is_running(pid):
+    """Return whether a process exists, and is not a zombie."""
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as f:
+            return f.read().rpartition(')')[2].split()[0] != 'Z'
+    except IOError:
+        return False
 
 class WorkerTests(unittest.TestCase):
     def test_worker_can_call_simple_function(self):
@@ -620,21 +1365,153 @@ class WorkerTests(unittest.TestCase):
         finally:
             w.close()
 
+    @unittest.skipIf(not hasattr(gc, 'freeze'), 'needs gc.freeze()')
+    def test_objects_are_frozen_before_a_worker_forks(self):
+        w = Worker()
+        try:
+            w.push()
+            self.assertTrue(w.call(gc.get_freeze_count) > 0)
+            w.pop()
+        finally:
+            w.close()
+
+    def test_workers_launched_together_are_separate_processes(self):
+        workers = launch_workers(3)
+        try:
+            pids = [w.call(os.getpid) for w in workers]
+            self.assertEqual(pids, [w.pids[0] for w in workers])
+            self.assertEqual(len(set(pids)), 3)
+            w = workers[0]
+            w.push()
+            self.assertEqual(w.call(mul, 3, 4), 12)
+            w.pop()
+            self.assertEqual(w.call(os.getpid), pids[0])
+        finally:
+            for w in workers:
+                w.close()
+
+    def test_closing_the_last_worker_reaps_their_server(self):
+        workers = launch_workers(2)
+        server_pid = workers[0].server.pid
+        for w in workers:
+            w.close()
+        self.assertRaises(OSError, os.waitpid, server_pid, os.WNOHANG)
+
+    def test_worker_survives_the_death_of_its_subprocess(self):
+        w = Worker()
+        try:
+            pid = w.call(os.getpid)
+            self.assertEqual(w.reap(), None)
+            w.push()
+            w.send(os._exit, 7)
+            select.select([w.exit_pipe], [], [])
+            status, messages = w.reap()
+            self.assertEqual(os.WEXITSTATUS(status), 7)
+            self.assertEqual(messages, [])
+            self.assertEqual(w.pids, [pid])
+            self.assertEqual(w.call(os.getpid), pid)
+        finally:
+            w.close()
+
+    @unittest.skipIf(not os.path.isdir('/proc/self'), 'needs /proc')
+    def test_popping_a_process_kills_the_children_it_leaves(self):
+        w = Worker()
+        try:
+            w.push()
+            pid = w.call(samples.fork_sleeper, 60)
+            self.assertTrue(is_running(pid))
+            w.pop()
+            deadline = time() + 5.0
+            while is_running(pid) and time() < deadline:
+                sleep(0.01)
+            self.assertFalse(is_running(pid))
+        finally:
+            w.close()
+
+    def test_worker_streams_several_results_per_read(self):
+        w = Worker()
+        try:
+            w.start(run_tests_of, 'assay.samples')
+            results = []
+            while StopIteration not in results:
+                results.extend(w.receive())
+        finally:
+            w.close()
+        self.assertEqual(len(results), 38)
+        self.assertEqual(results[-1], StopIteration)
+
+    def test_worker_sends_first_result_before_a_slow_second_one(self):
+        w = Worker()
+        try:
+            w.start(pause_between, 'a', 'b', 5.0)
+            t0 = time()
+            select.select([w], [], [])
+            results = w.receive()
+            dt = time() - t0
+        finally:
+            w.close()
+        self.assertEqual(results, ['a'])
+        self.assertLess(dt, 4.0)
+
+    @unittest.skipIf(sys.version_info < (3, 5), 'needs retried syscalls')
+    def test_worker_sends_quick_results_before_a_long_pause(self):
+        w = Worker()
+        try:
+            w.start(samples.pause_after, ['a', 'b'], 1.0)
+            t0 = time()
+            results = []
+            while 'b' not in results:
+                select.select([w], [], [])
+                results.extend(w.receive())
+            dt = time() - t0
+            while StopIteration not in results:
+                select.select([w], [], [])
+                results.extend(w.receive())
+            total = time() - t0
+        finally:
+            w.close()
+        self.assertEqual(results, ['a', 'b', StopIteration])
+        self.assertLess(dt, 0.5)
+        self.assertGreaterEqual(total, 1.0)
+
+    def test_worker_runs_generators_without_a_helper_thread(self):
+        w = Worker()
+        try:
+            w.start(samples.count_threads, 3, 0.1)
+            results = []
+            while StopIteration not in results:
+                select.select([w], [], [])
+                results.extend(w.receive())
+        finally:
+            w.close()
+        self.assertEqual(results, [1, 1, 1, StopIteration])
+
     def test_worker_survive_narrow_pipe(self):
         # This simulates a difficult-to-reproduce problem: until we
         # enhanced the Worker, on Python 3 on GitHub Actions the main
         # process would sometimes raise "_pickle.UnpicklingError: pickle
-        # data was truncated".
-        if not _python3:
-            return
+        # data was truncated".  Here a message arrives in small blocks,
+        # so that each read returns only part of it.
         n = 5 * PRETEND_PIPE_LIMIT
+        f = io.BytesIO()
+        worker.write_message(f, 'a' * n)
+        data = f.getvalue()
         w = Worker()
-        w.from_worker = BlockReader(w.from_worker)
+        from_worker = w.from_worker
+        fd, to_main = os.pipe()
+        w.from_worker = os.fdopen(fd, 'rb', 0)
+        received = []
         try:
-            answer = w.call(mul, 'a', n)
+            for i in range(0, len(data), PRETEND_PIPE_LIMIT):
+                self.assertEqual(received, [])
+                os.write(to_main, data[i:i + PRETEND_PIPE_LIMIT])
+                received.extend(w.receive())
         finally:
+            w.from_worker.close()
+            w.from_worker = from_worker
+            os.close(to_main)
             w.close()
-        self.assertEqual(answer, 'a' * n)
+        self.assertEqual(received, ['a' * n])
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,177 @@
+"""Notice tests that run too long, and learn where they are stuck.
+
+The same stack dumps also show where a test was when it crashed.
+
+"""
+
+import linecache
+import os
+import re
+import signal
+from contextlib import contextmanager
+from time import sleep, time
+from . import runner
+from .runner import relativize
+
+try:
+    import faulthandler
+except ImportError:
+    faulthandler = None  # Python 2: timeouts are reported without a stack
+
+STACK_SIGNAL = signal.SIGUSR1
+_stack_file = None
+_frame_pattern = re.compile(r'^  File "(.*)", line (\d+) in (.*)$', re.M)
+
+class Timeouts(object):
+    """Deadlines for the test, and for the job, that each worker is running.
+
+    A worker's test deadline is reset by `progress()` each time one of
+    its tests finishes, while its job deadline runs from `start()` until
+    the whole job is done.  Either limit can be None for no limit.
+
+    """
+    def __init__(self, test_seconds=None, job_seconds=None):
+        self.test_seconds = test_seconds
+        self.job_seconds = job_seconds
+        self.test_deadlines = {}
+        self.job_deadlines = {}
+
+    def start(self, worker):
+        now = time()
+        if self.test_seconds is not None:
+            self.test_deadlines[worker] = now + self.test_seconds
+        if self.job_seconds is not None:
+            self.job_deadlines[worker] = now + self.job_seconds
+
+    def progress(self, worker):
+        if self.test_seconds is not None:
+            self.test_deadlines[worker] = time() + self.test_seconds
+
+    def stop(self, worker):
+        self.test_deadlines.pop(worker, None)
+        self.job_deadlines.pop(worker, None)
+
+    def expired(self):
+        """Return a list of ``(worker, seconds)`` whose time has run out.
+
+        The `seconds` are those of whichever limit the worker exceeded.
+
+        """
+        now = time()
+        expired = []
+        workers = set(self.test_deadlines) | set(self.job_deadlines)
+        for worker in workers:
+            if self.job_deadlines.get(worker, now + 1) <= now:
+                expired.append((worker, self.job_seconds))
+            elif self.test_deadlines.get(worker, now + 1) <= now:
+                expired.append((worker, self.test_seconds))
+        return expired
+
+    def seconds_left(self):
+        """Return the seconds until the next deadline, or None if none."""
+        deadlines = (list(self.test_deadlines.values())
+                     + list(self.job_deadlines.values()))
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time())
+
+def enable_stack_dumps(path):
+    """In a worker, dump the stack to `path` upon receiving STACK_SIGNAL.
+
+    The processes that the worker forks inherit the handler, which the
+    faulthandler module runs even if Python itself is stuck in C code.
+    The stack is also dumped if a process dies from a fatal signal.
+
+    """
+    global _stack_file
+    if faulthandler is not None:
+        _stack_file = open(path, 'a')
+        faulthandler.register(STACK_SIGNAL, file=_stack_file,
+                              all_threads=True)
+        faulthandler.enable(file=_stack_file, all_threads=True)
+
+@contextmanager
+def stack_dumps_from(pid):
+    """Pass requests for our stack on to the child process `pid`.
+
+    A process that runs a test in a child only waits for the child to
+    finish, so the stack worth dumping is the child's.
+
+    """
+    if _stack_file is None:
+        yield
+        return
+
+    def forward(signum, frame):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass            # the child has already exited
+
+    signal.signal(STACK_SIGNAL, forward)
+    try:
+        yield
+    finally:
+        faulthandler.unregister(STACK_SIGNAL)
+        faulthandler.register(STACK_SIGNAL, file=_stack_file,
+                              all_threads=True)
+
+def dump_stack(pid, path, wait=1.0):
+    """Ask process `pid` for its stack, and return it as traceback frames.
+
+    Returns an empty list if the process does not respond in time.
+
+    """
+    if faulthandler is None:
+        return []
+    try:
+        size = os.path.getsize(path)
+        os.kill(pid, STACK_SIGNAL)
+    except OSError:
+        return []
+    deadline = time() + wait
+    previous_text = ''
+    while time() < deadline:
+        sleep(0.01)
+        text = read_stack_file(path, size)
+        if text and text == previous_text:
+            break
+        previous_text = text
+    return parse_stack(previous_text)
+
+def read_stack_file(path, offset):
+    """Return what has been written to the stack file since `offset`."""
+    with open(path) as f:
+        f.seek(offset)
+        return f.read()
+
+def parse_stack(text):
+    """Turn a faulthandler dump into frames, outermost call first.
+
+    Of the threads dumped, the one running a test is chosen, which is
+    the thread whose stack passes through Assay's test runner.
+
+    """
+    runner_filename = _source_of(runner)
+    blocks = [_frame_pattern.findall(block) for block in text.split('\n\n')]
+    blocks = [block for block in blocks if block]
+    if not blocks:
+        return []
+    for block in blocks:
+        if any(filename == runner_filename for filename, n, name in block):
+            break
+    # Keep only the frames called by the runner, which the dump lists
+    # first, as it starts with the most recent call.
+    for i, (filename, lineno, name) in enumerate(block):
+        if filename == runner_filename:
+            block = block[:i]
+            break
+    frames = []
+    for filename, lineno, name in reversed(block):
+        lineno = int(lineno)
+        line = linecache.getline(filename, lineno).strip() or None
+        frames.append((relativize(filename), lineno, name, line))
+    return frames
+
+def _source_of(module):
+    return module.__file__.rstrip('co')  # in case it is a .pyc or .pyo
@@ -1,5 +1,6 @@
 """Support for users interacting with the terminal."""
 
+import ctypes
 import errno
 import fcntl
 import os
@@ -12,6 +13,12 @@ import tty
 from contextlib import contextmanager
 
 _everything = 1024 * 1024
+_PR_SET_PDEATHSIG = 1
+
+try:
+    _prctl = ctypes.CDLL(None, use_errno=True).prctl
+except (AttributeError, OSError):
+    _prctl = None   # not Linux
 
 @contextmanager
 def configure_tty():
@@ -41,7 +48,23 @@ def keep_on_exec(fd):
     fcntl.fcntl(fd, fcntl.F_SETFD, 0)
 
 def cpu_count():
-    """Return the number of CPUs on the system."""
+    """Return the number of CPUs that this process is allowed to use.
+
+    This is the number of CPUs in our affinity mask, further limited by
+    any CPU quota that our control group imposes, so a container given
+    a quota of 4 CPUs on a 64-CPU machine counts as having 4.
+
+    """
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        count = _count_processors()
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        count = min(count, max(1, int(quota + 0.5)))
+    return count
+
+def _count_processors():
     if os.path.exists('/proc/cpuinfo'):
         with open('/proc/cpuinfo') as f:
             count = len(re.findall(r'^processor\s*:', f.read(), re.M))
@@ -49,6 +72,118 @@ def cpu_count():
             return count
     return 2
 
+def _cgroup_cpu_quota():
+    """Return our control group's CPU quota as a float, or None if none."""
+    text = _read_cgroup_file('', 'cpu.max')
+    if text is not None:
+        fields = text.split()
+        if len(fields) == 2 and fields[0] != 'max':
+            return float(fields[0]) / float(fields[1])
+        return None
+    quota = _read_cgroup_file('cpu', 'cpu.cfs_quota_us')
+    period = _read_cgroup_file('cpu', 'cpu.cfs_period_us')
+    if quota is None or period is None or int(quota) <= 0:
+        return None
+    return float(quota) / float(period)
+
+def available_memory():
+    """Return how many bytes of memory we could use, or None if unknown.
+
+    This is the kernel's estimate of available memory, limited by any
+    memory limit that our control group imposes.
+
+    """
+    available = None
+    try:
+        with open('/proc/meminfo') as f:
+            match = re.search(r'^MemAvailable:\s*(\d+) kB', f.read(), re.M)
+    except (IOError, OSError):
+        match = None
+    if match is not None:
+        available = int(match.group(1)) * 1024
+    limit = _read_cgroup_file('', 'memory.max')
+    if limit is None:
+        limit = _read_cgroup_file('memory', 'memory.limit_in_bytes')
+    if limit is not None and limit.isdigit():
+        usage = (_read_cgroup_file('', 'memory.current')
+                 or _read_cgroup_file('memory', 'memory.usage_in_bytes')
+                 or '0')
+        room = max(0, int(limit) - int(usage))
+        if available is None or room < available:
+            available = room
+    return available
+
+def _read_cgroup_file(controller, filename):
+    """Read a file from our control group, or return None if it is absent.
+
+    A `controller` of ``''`` means the unified cgroup v2 hierarchy.  As
+    a container often sees its own control group as the root of the
+    hierarchy, the root is tried if the full path does not exist.
+
+    """
+    try:
+        with open('/proc/self/cgroup') as f:
+            lines = f.read().splitlines()
+    except (IOError, OSError):
+        return None
+    for line in lines:
+        fields = line.split(':', 2)
+        if len(fields) != 3:
+            continue
+        number, controllers, path = fields
+        if controller:
+            if controller not in controllers.split(','):
+                continue
+            base = os.path.join('/sys/fs/cgroup', controllers)
+        elif number == '0' and not controllers:
+            base = '/sys/fs/cgroup'
+        else:
+            continue
+        for directory in (base + path, base):
+            try:
+                with open(os.path.join(directory, filename)) as f:
+                    return f.read().strip()
+            except (IOError, OSError):
+                pass
+    return None
+
+def memory_usage(pid):
+    """Return ``(shared, private)`` bytes of memory used by process `pid`.
+
+    Shared memory includes pages that a forked child still shares with
+    its parent, so it measures how well copy-on-write is working.
+    Returns None if the kernel does not offer the numbers.
+
+    """
+    for name in 'smaps_rollup', 'smaps':
+        try:
+            with open('/proc/{0}/{1}'.format(pid, name)) as f:
+                text = f.read()
+        except (IOError, OSError):
+            continue
+        totals = {'Shared': 0, 'Private': 0}
+        for kind, kb in re.findall(r'^(Shared|Private)_(?:Clean|Dirty):'
+                                   r'\s*(\d+) kB', text, re.M):
+            totals[kind] += int(kb) * 1024
+        return totals['Shared'], totals['Private']
+    return None
+
+def resident_memory(pid):
+    """Return ``(current, peak)`` resident bytes of process `pid`.
+
+    Returns None if the kernel does not offer the numbers.
+
+    """
+    try:
+        with open('/proc/{0}/status'.format(pid)) as f:
+            text = f.read()
+    except (IOError, OSError):
+        return None
+    sizes = dict(re.findall(r'^(VmRSS|VmHWM):\s*(\d+) kB', text, re.M))
+    if len(sizes) != 2:
+        return None
+    return int(sizes['VmRSS']) * 1024, int(sizes['VmHWM']) * 1024
+
 def discard_input(fileobj, bufsize):
     """Discard all bytes queued for input on `fileobj`.
 
@@ -67,9 +202,70 @@ def discard_input(fileobj, bufsize):
     fileobj.close()
     return os.fdopen(new_fd, fileobj.mode, bufsize)
 
+def read_available(fd):
+    """Return the bytes queued for input on `fd`, without blocking."""
+    pieces = []
+    fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
+    try:
+        while True:
+            data = os.read(fd, _everything)
+            if not data:
+                break
+            pieces.append(data)
+    except OSError as e:
+        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+    finally:
+        fcntl.fcntl(fd, fcntl.F_SETFL, 0)
+    return b''.join(pieces)
+
+def is_readable(fd):
+    """Return whether reading from `fd` would return at once."""
+    return bool(select.select([fd], [], [], 0)[0])
+
 def kill_dash_9(pid):
-    """Kill a process with a signal that cannot be caught or ignored."""
-    os.kill(pid, signal.SIGKILL)
+    """Kill a process with a signal that cannot be caught or ignored.
+
+    A process that has already exited, and been reaped, is ignored.
+
+    """
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+def kill_process_group(pgid):
+    """Kill every process in a process group, if any are left."""
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+def die_with_parent(parent_pid):
+    """Have Linux kill this process as soon as its parent `parent_pid` dies.
+
+    Call this right after forking; if the parent has died already, this
+    process exits at once.  Elsewhere than Linux, nothing is done.
+
+    """
+    if _prctl is None:
+        return
+    _prctl(_PR_SET_PDEATHSIG, signal.SIGKILL, 0, 0, 0)
+    if os.getppid() != parent_pid:
+        os._exit(1)
+
+def describe_exit(status):
+    """Describe a status from ``os.waitpid()``, like 'killed by SIGSEGV'."""
+    if os.WIFSIGNALED(status):
+        number = os.WTERMSIG(status)
+        try:
+            name = signal.Signals(number).name
+        except (AttributeError, ValueError):  # Python 2, or unknown signal
+            name = 'signal {0}'.format(number)
+        return 'killed by {0}'.format(name)
+    return 'exit status {0}'.format(os.WEXITSTATUS(status))
 
 class EPoll(object):
     """File descriptor polling object that returns objects, not integers."""
@@ -78,8 +274,10 @@ class EPoll(object):
         self.fdmap = {}
         try:
             self.poller = select.epoll()
+            self.timeout_scale = 1.0
         except AttributeError:
             self.poller = select.poll()  # TODO: does this work on OS X?
+            self.timeout_scale = 1000.0  # poll() takes milliseconds
 
     def register(self, obj, flags=None):
         if flags is None:
@@ -96,12 +294,27 @@ class EPoll(object):
         del self.fdmap[fd]
         self.poller.unregister(fd)
 
-    def events(self):
+    def events(self, timeout=None):
+        """Yield ``(object, flags)`` for each event, forever.
+
+        If `timeout` is given, it is called before each poll to learn how
+        many seconds to wait, or None to wait indefinitely; and each time
+        a wait expires without any events, ``(None, 0)`` is yielded.
+
+        """
         while True:
+            seconds = None if timeout is None else timeout()
+            if seconds is None:
+                wait = -1
+            else:
+                wait = seconds * self.timeout_scale
             try:
-                for fd, flags in self.poller.poll():
-                    yield self.fdmap[fd], flags
+                events = self.poller.poll(wait)
             except IOError as e:
                 if e.errno != errno.EINTR:
                     raise
-
+                continue
+            if not events and seconds is not None:
+                yield None, 0
+            for fd, flags in events:
+                yield self.fdmap[fd], flags
@@ -1,9 +1,15 @@
 """A worker process that can respond to commands."""
 
+import gc
 import os
+import signal
+import struct
 import sys
+from collections import deque
+from time import time
 from . import unix
-from .fixes import _accumulating_reader
+from .importation import record_imports
+from .rewriting import install_import_hook
 from types import GeneratorType
 
 _python3 = sys.version_info >= (3,)
@@ -13,45 +19,70 @@ if _python3:
 else:
     import cPickle as pickle
 
+# When a worker process exits, its parent sends this byte on the "sync"
+# pipe, followed by the exit status that ``os.waitpid()`` reported.
 WORKER_TERMINATED = b'!'
+EXIT_STATUS = struct.Struct('!i')
 
 # A crucial setting: the buffer size for input from a worker process.
-# If we were to allow buffering of data from the worker, then the buffer
-# might read ahead on the input stream and leave the descriptor looking
-# empty from the point of view of epoll().
+# If we were to allow Python to buffer data from the worker, then the
+# buffer might read ahead on the input stream and leave the descriptor
+# looking empty from the point of view of epoll().  Instead, we read
+# large blocks ourselves, and unpack every complete message we find.
 BUFSIZE = 0
+READ_SIZE = 65536
+
+# Each message is a pickle, preceded by a header giving its length.
+HEADER = struct.Struct('!I')
+
+# Before forking, the objects that exist are moved to a permanent
+# generation that the garbage collector ignores, so that a collection
+# in the child does not write to their headers and un-share their pages.
+freeze = getattr(gc, 'freeze', lambda: None)
+
+# Generator items are sent in batches of at most this many items or
+# bytes, and a batch is sent early if this many seconds have passed
+# since the previous one.
+BATCH_SIZE = 100
+BATCH_BYTES = 32768
+BATCH_SECONDS = 0.05
+
+# Python 3.5 and later retry a system call that a signal interrupts,
+# so only there can a timer signal send a batch in the middle of a test
+# without cutting short the test's sleeps and reads.
+_batch_timer = sys.version_info >= (3, 5) and hasattr(signal, 'setitimer')
 
 class Worker(object):
     """An object in the main process for communicating with one worker."""
 
-    def __init__(self):
-        from_parent, to_worker = os.pipe()
-        from_worker, to_parent = os.pipe()
-        sync_from_worker, sync_to_parent = os.pipe()
+    def __init__(self, pipes=None, pid=None, server=None):
+        """Launch a worker, or adopt one that `launch_workers()` started.
 
-        unix.close_on_exec(to_worker)
-        unix.close_on_exec(from_worker)
-        unix.close_on_exec(sync_from_worker)
+        An adopted worker is given the `ServerProcess` that forked it.
 
-        unix.keep_on_exec(from_parent)
-        unix.keep_on_exec(to_parent)
-        unix.keep_on_exec(sync_to_parent)
-
-        worker_pid = os.fork()
-        if not worker_pid:
-            os.setpgrp()  # prevent worker from receiving Ctrl-C
-            python = sys.executable
-            os.execvp(python, [python, '-m', 'assay.worker', str(from_parent),
-                               str(to_parent), str(sync_to_parent)])
+        """
+        self.server = server
+        if pipes is None:
+            pipes = make_pipes()
+            worker_pid = os.fork()
+            if not worker_pid:
+                os.setpgrp()  # prevent worker from receiving Ctrl-C
+                python = sys.executable
+                os.execvp(python, [python, '-m', 'assay.worker']
+                          + [str(fd) for fd in pipes[1]])
+            pid = worker_pid
 
-        os.close(from_parent)
-        os.close(to_parent)
-        os.close(sync_to_parent)
+        (to_worker, from_worker, sync_from_worker), worker_fds = pipes
+        for fd in worker_fds:
+            os.close(fd)
 
-        self.pids = [worker_pid]
+        self.pids = [pid]
         self.to_worker = os.fdopen(to_worker, 'wb')
         self.from_worker = os.fdopen(from_worker, 'rb', BUFSIZE)
         self.sync_from_worker = sync_from_worker
+        self.buffer = bytearray()
+        self.messages = deque()
+        self.exit_pipe = ExitPipe(self)
 
     def push(self):
         """Have the worker push a new subprocess on top of the stack."""
@@ -67,24 +98,100 @@ class Worker(object):
 
         """
         unix.kill_dash_9(self.pids.pop())
-        assert os.read(self.sync_from_worker, 1) == WORKER_TERMINATED
-        # Subtle - worker could have died in mid-pickle:
+        self._read_exit_status()
+        # Subtle - worker could have died in mid-message:
         self.from_worker = unix.discard_input(self.from_worker, BUFSIZE)
+        del self.buffer[:]
+        self.messages.clear()
+
+    def reap(self):
+        """Learn whether the active subprocess has exited on its own.
+
+        Call this when epoll() reports that our `exit_pipe` is readable.
+        If a subprocess has indeed died, perhaps from a segfault, it is
+        popped from the stack, and ``(status, messages)`` is returned:
+        its exit status, and the complete messages it sent before dying.
+        Otherwise, None is returned.
+
+        """
+        if not unix.is_readable(self.sync_from_worker):
+            return None
+        status = self._read_exit_status()
+        self.pids.pop()
+        self.buffer += unix.read_available(self.from_worker.fileno())
+        self._unpack()
+        del self.buffer[:]  # the dead process's last, partial message
+        messages = list(self.messages)
+        self.messages.clear()
+        return status, messages
+
+    def _read_exit_status(self):
+        data = os.read(self.sync_from_worker, 1 + EXIT_STATUS.size)
+        if data[:1] != WORKER_TERMINATED:
+            raise EOFError('worker closed its sync pipe')
+        status, = EXIT_STATUS.unpack(data[1:])
+        return status
 
     def call(self, function, *args, **kw):
         """Run a function in the worker process and return its result."""
-        pickle.dump((function, args, kw), self.to_worker)
-        self.to_worker.flush()
-        return pickle.load(_accumulating_reader(self.from_worker))
+        self.send(function, *args, **kw)
+        return self.reply()
+
+    def send(self, function, *args, **kw):
+        """Start a function running in the worker, without waiting for it.
+
+        This lets several workers run functions at the same time, with
+        their results collected afterwards by calling `reply()`.
+
+        """
+        write_message(self.to_worker, (function, args, kw))
+
+    def reply(self):
+        """Wait for the function given to `send()` and return its result."""
+        messages = self.messages
+        while not messages:
+            self._read()
+        return messages.popleft()
 
     def start(self, generator, *args, **kw):
         """Start a generator in the worker process."""
-        pickle.dump((generator, args, kw), self.to_worker)
-        self.to_worker.flush()
+        write_message(self.to_worker, (generator, args, kw))
+
+    def receive(self):
+        """Return every message that has arrived, reading at most once.
+
+        This makes at most one ``read()`` call, and only if the pipe is
+        readable, so it will not block even if epoll() reported an event
+        that went stale when the worker's subprocess was replaced; but it
+        might return an empty list if only part of a message has arrived.
+
+        """
+        if not self.messages and unix.is_readable(self.fileno()):
+            self._read()
+        messages = list(self.messages)
+        self.messages.clear()
+        return messages
+
+    def _read(self):
+        """Read from the worker, then unpack any messages now complete."""
+        data = os.read(self.from_worker.fileno(), READ_SIZE)
+        if not data:
+            raise EOFError('worker closed its pipe')
+        self.buffer += data
+        self._unpack()
 
-    def next(self):
-        """Return the next item from the generator given to `start()`."""
-        return pickle.load(_accumulating_reader(self.from_worker))
+    def _unpack(self):
+        buffer = self.buffer
+        length = len(buffer)
+        i = 0
+        while length - i >= HEADER.size:
+            size, = HEADER.unpack_from(buffer, i)
+            j = i + HEADER.size + size
+            if j > length:
+                break
+            self.messages.append(pickle.loads(bytes(buffer[i+HEADER.size:j])))
+            i = j
+        del buffer[:i]
 
     def fileno(self):
         """Return the incoming file descriptor, for `epoll()` objects."""
@@ -99,12 +206,121 @@ class Worker(object):
         self.pop()
 
     def close(self):
-        """Kill the worker and close our file descriptors."""
+        """Kill the worker, close our file descriptors, and reap it.
+
+        The worker is our own child, unless a server process forked it,
+        in which case the server is reaped once all its workers close.
+
+        """
+        worker_pid = self.pids[0] if self.pids else None
         while self.pids:
             unix.kill_dash_9(self.pids.pop())
         self.to_worker.close()
         self.from_worker.close()
         os.close(self.sync_from_worker)
+        if self.server is None:
+            if worker_pid is not None:
+                os.waitpid(worker_pid, 0)
+        else:
+            self.server.release()
+
+class ExitPipe(object):
+    """Lets epoll() watch for the death of a worker's active subprocess."""
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def fileno(self):
+        return self.worker.sync_from_worker
+
+class ServerProcess(object):
+    """The process that forked a group of workers, and that reaps them.
+
+    It exits once all of its workers have died, and is then reaped in
+    turn when the last of the workers is closed.
+
+    """
+    def __init__(self, pid, worker_count):
+        self.pid = pid
+        self.worker_count = worker_count
+
+    def release(self):
+        """Note that a worker has been closed, reaping us after the last."""
+        self.worker_count -= 1
+        if not self.worker_count:
+            os.waitpid(self.pid, 0)
+
+def make_pipes():
+    """Create the pipes between the main process and a new worker.
+
+    Returns a tuple of two tuples: the file descriptors that we keep,
+    and the file descriptors that the worker will inherit.
+
+    """
+    from_parent, to_worker = os.pipe()
+    from_worker, to_parent = os.pipe()
+    sync_from_worker, sync_to_parent = os.pipe()
+
+    unix.close_on_exec(to_worker)
+    unix.close_on_exec(from_worker)
+    unix.close_on_exec(sync_from_worker)
+
+    unix.keep_on_exec(from_parent)
+    unix.keep_on_exec(to_parent)
+    unix.keep_on_exec(sync_to_parent)
+
+    return ((to_worker, from_worker, sync_from_worker),
+            (from_parent, to_parent, sync_to_parent))
+
+def launch_workers(count):
+    """Start `count` workers at once, and return their `Worker` objects.
+
+    Instead of each worker booting a Python interpreter of its own, a
+    single server process is exec'd, which then forks every worker.
+
+    """
+    pipes = [make_pipes() for i in range(count)]
+    from_server, to_parent = os.pipe()
+    unix.close_on_exec(from_server)
+    unix.keep_on_exec(to_parent)
+    server_pid = os.fork()
+    if not server_pid:
+        os.setpgrp()  # prevent workers from receiving Ctrl-C
+        python = sys.executable
+        os.execvp(python, [python, '-m', 'assay.worker', 'server',
+                           str(to_parent)]
+                  + [','.join(str(fd) for fd in worker_fds)
+                     for parent_fds, worker_fds in pipes])
+    os.close(to_parent)
+    with os.fdopen(from_server, 'rb') as f:
+        pids = read_message(f)
+    server = ServerProcess(server_pid, count)
+    return [Worker(p, pid, server) for p, pid in zip(pipes, pids)]
+
+def server_process(to_parent, fd_lists):
+    """Fork a worker for each list of file descriptors, then reap them."""
+    freeze()
+    pids = []
+    for fds in fd_lists:
+        pid = os.fork()
+        if not pid:
+            os.close(to_parent)
+            for other_fds in fd_lists:
+                if other_fds is not fds:
+                    for fd in other_fds:
+                        os.close(fd)
+            try:
+                worker_process(*fds)
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    for fds in fd_lists:
+        for fd in fds:
+            os.close(fd)
+    with os.fdopen(to_parent, 'wb') as f:
+        write_message(f, pids)
+    for pid in pids:
+        os.waitpid(pid, 0)
 
 def worker_process(from_parent, to_parent, sync_to_parent):
     """Run functions piped to us from the parent process.
@@ -122,30 +338,156 @@ def worker_process(from_parent, to_parent, sync_to_parent):
     descriptors of the pipes connecting us to the parent process.
 
     """
+    record_imports()
+    install_import_hook()
     to_parent = os.fdopen(to_parent, 'wb')
     from_parent = os.fdopen(from_parent, 'rb')
 
     while True:
-        function, args, kw = pickle.load(_accumulating_reader(from_parent))
+        function, args, kw = read_message(from_parent)
+        if function is os.fork:
+            freeze()
         result = function(*args, **kw)
         if function is os.fork:
             if result:
-                os.waitpid(result, 0)
+                # Each process leads a group of its own, so that when it
+                # dies, any children it leaves behind can be killed too.
+                try:
+                    os.setpgid(result, result)
+                except OSError:
+                    pass        # the child has already done it, or died
+                pid, status = os.waitpid(result, 0)
+                unix.kill_process_group(result)
                 # Subtle: worker can die with a command still inbound
                 from_parent = unix.discard_input(from_parent, BUFSIZE)
-                os.write(sync_to_parent, WORKER_TERMINATED)
+                os.write(sync_to_parent,
+                         WORKER_TERMINATED + EXIT_STATUS.pack(status))
                 continue
+            os.setpgid(0, 0)
             result = os.getpid()
         elif isinstance(result, GeneratorType):
+            batch = Batch(to_parent)
             for item in result:
-                pickle.dump(item, to_parent, 2)
-                to_parent.flush()
-            result = StopIteration
-        pickle.dump(result, to_parent, 2)
-        to_parent.flush()
+                batch.append(item)
+            batch.append(StopIteration)
+            batch.close()
+            continue
+        write_message(to_parent, result)
+
+class Batch(object):
+    """Send generator items to the parent in batches, not one at a time.
+
+    Each item is still its own message, but messages are saved up and
+    written together once there are enough of them, or once the last
+    write is `BATCH_SECONDS` old.  So an item that arrives after a pause,
+    like the result of a slow test, is sent at once; only items that
+    arrive in quick succession are held back.
+
+    No timer thread is used, as the tests run in this same process and
+    might fork, or count their threads.  Instead, a SIGALRM timer is
+    armed when an item is held back, so that it is sent even if the
+    generator then blocks for a long time.  A test that installs its
+    own SIGALRM handler simply leaves its items waiting for the next
+    item, or for the generator to finish.
+
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.pieces = []
+        self.size = 0
+        self.sent_at = 0.0
+        self.pid = os.getpid()
+        self.busy = False       # whether our own code is running
+        self.late = False       # whether the timer fired while it was
+        self.armed = False
+        self.timed = (_batch_timer and
+                      signal.getsignal(signal.SIGALRM) == signal.SIG_DFL)
+        if self.timed:
+            signal.signal(signal.SIGALRM, self.deadline)
+            signal.siginterrupt(signal.SIGALRM, False)
+
+    def append(self, item):
+        self.busy = True
+        data = pickle.dumps(item, 2)
+        self.pieces.append(HEADER.pack(len(data)))
+        self.pieces.append(data)
+        self.size += HEADER.size + len(data)
+        self.busy = False
+        if (self.size >= BATCH_BYTES or len(self.pieces) >= BATCH_SIZE * 2
+            or time() - self.sent_at >= BATCH_SECONDS or self.late):
+            self.send()
+        elif self.timed and not self.armed:
+            self.arm()
+
+    def arm(self):
+        """Start the timer, unless a test has taken over SIGALRM."""
+        if signal.getsignal(signal.SIGALRM) != self.deadline:
+            self.timed = False
+            return
+        self.armed = True
+        signal.setitimer(signal.ITIMER_REAL, BATCH_SECONDS)
+
+    def deadline(self, signum, frame):
+        """Handle SIGALRM by sending the items that are waiting."""
+        if os.getpid() != self.pid:
+            return              # a child forked by a test
+        self.armed = False
+        if self.busy:
+            self.late = True
+        else:
+            self.send()
+
+    def send(self):
+        """Send any items that are waiting, and stop the timer."""
+        self.busy = True
+        if self.armed:
+            self.armed = False
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        if self.pieces:
+            self.fileobj.write(b''.join(self.pieces))
+            self.fileobj.flush()
+            self.pieces = []
+            self.size = 0
+        self.sent_at = time()
+        self.late = False
+        self.busy = False
+
+    def close(self):
+        """Send any items that are waiting, and give back SIGALRM."""
+        self.send()
+        if self.timed and signal.getsignal(signal.SIGALRM) == self.deadline:
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+
+def write_message(fileobj, value):
+    """Pickle `value` and write it, with its length, as a single message."""
+    data = pickle.dumps(value, 2)
+    fileobj.write(HEADER.pack(len(data)) + data)
+    fileobj.flush()
+
+def read_message(fileobj):
+    """Read a single message, blocking until all of it has arrived."""
+    size, = HEADER.unpack(read_exactly(fileobj, HEADER.size))
+    return pickle.loads(read_exactly(fileobj, size))
+
+def read_exactly(fileobj, size):
+    """Read `size` bytes, even from a file that returns fewer per read."""
+    pieces = []
+    while size:
+        data = fileobj.read(size)
+        if not data:
+            raise EOFError('pipe closed in mid-message')
+        size -= len(data)
+        pieces.append(data)
+    return b''.join(pieces)
 
 if __name__ == '__main__':
     try:
-        worker_process(int(sys.argv[1]), int(sys.argv[2]), int(sys.argv[3]))
+        if sys.argv[1] == 'server':
+            server_process(int(sys.argv[2]),
+                           [[int(fd) for fd in fds.split(',')]
+                            for fds in sys.argv[3:]])
+        else:
+            worker_process(int(sys.argv[1]), int(sys.argv[2]),
+                           int(sys.argv[3]))
     except KeyboardInterrupt:
         pass